@@ -16,11 +16,22 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 from __future__ import print_function, division
-import sys, os, socket, jinja2, yaml, argparse, re, copy, traceback
+import sys, os, io, socket, jinja2, yaml, argparse, re, copy, traceback, collections, hashlib, marshal, tempfile, json
 
 __version__ = '1.3.3'
 jinja2_filters = []
 
+expand_any_re = re.compile(r'(?<!\\)[\(\[\{]')
+expand_group_re = re.compile(r'(?<!\\)\((.+?)(?<!\\)\)')
+expand_alt_re = re.compile(r'(?<!\\)\|')
+expand_counter_re = re.compile(r'(?<!\\)\{[ \t]*([0-9]+-[0-9]+):([0-9]+)(?::([0-9]+))?[ \t]*(?<!\\)\}')
+expand_class_re = re.compile(r'(?<!\\)\[([A-Z0-9\-]+)(?<!\\)\]', re.IGNORECASE)
+expand_range_re = re.compile(r'(?:[A-Z]-[^A-Z]|[a-z]-[^a-z]|[0-9]-[^0-9]|[^A-Za-z0-9]-)')
+expand_chars_re = re.compile('([A-Z0-9](-[A-Z0-9])?)', re.IGNORECASE)
+expand_ob_re = re.compile(r'(?<!\\)\(')
+expand_cb_re = re.compile(r'(?<!\\)\)')
+expand_unescape_re = re.compile(r'\\([\|\(\[\)\]])')
+
 class ArgumentParser(argparse.ArgumentParser):
   def error(self, message):
     if '-q' not in sys.argv:
@@ -69,30 +80,85 @@ def main():
       print('JinjaFx v' + __version__ + ' - Jinja Templating Tool')
       print('Copyright (c) 2020-2021 Chris Mason <chris@jinjafx.org>\n')
 
-    jinjafx_usage = '(-t <template.j2> [-d <data.csv>] | -dt <dt.yml>) [-g <vars.yml>] [-o <output file>] [-od <output dir>] [-m] [-q]'
+    jinjafx_usage = '(-t <template.j2> [-d <data.csv>] | -dt <dt.yml> | -merge <shard.json> ...) [-d <name>=<data.csv> ...] [-g <vars.yml>] [-o <output file>] [-od <output dir>] [-dc <cache dir>] [-pv <rows>] [-shard <i/N> [-stateless]] [-m] [-q]'
 
     parser = ArgumentParser(add_help=False, usage='%(prog)s ' + jinjafx_usage)
     group_ex = parser.add_mutually_exclusive_group(required=True)
     group_ex.add_argument('-dt', metavar='<dt.yml>', type=argparse.FileType('r'))
     group_ex.add_argument('-t', metavar='<template.j2>', type=argparse.FileType('r'))
-    parser.add_argument('-d', metavar='<data.csv>', type=argparse.FileType('r'))
+    group_ex.add_argument('-merge', metavar='<shard.json>', type=str, nargs='+')
+    parser.add_argument('-d', metavar='[<name>=]<data.csv>', type=str, action='append')
     parser.add_argument('-g', metavar='<vars.yml>', type=argparse.FileType('r'), action='append')
     parser.add_argument('-o', metavar='<output file>', type=str)
     parser.add_argument('-od', metavar='<output dir>', type=str)
+    parser.add_argument('-dc', metavar='<cache dir>', type=str)
+    parser.add_argument('-pv', metavar='<rows>', type=int)
+    parser.add_argument('-shard', metavar='<i/N>', type=str)
+    parser.add_argument('-stateless', action='store_true')
     parser.add_argument('-m', action='store_true')
     parser.add_argument('-q', action='store_true')
     args = parser.parse_args()
 
-    if args.dt is not None and args.d is not None:
+    dfiles = {}
+
+    if args.d is not None:
+      for d in args.d:
+        m = re.match(r'^([A-Z_][A-Z0-9_]*)=(.+)$', d, re.IGNORECASE)
+        if m and not os.path.isfile(d):
+          name, d = m.group(1), m.group(2)
+        else:
+          name = None
+
+        if name in dfiles:
+          if name is None:
+            parser.error("argument -d: only one unnamed data file is allowed")
+          else:
+            parser.error("argument -d: duplicate dataset name '" + name + "'")
+
+        if not os.path.isfile(d) or not os.access(d, os.R_OK):
+          parser.error("argument -d: can't open '" + d + "'")
+
+        dfiles[name] = d
+
+    if args.dt is not None and None in dfiles:
       parser.error("argument -d: not allowed with argument -dt")
 
     if args.m is True and args.g is None:
       parser.error("argument -m: only allowed with argument -g")
 
+    if args.shard is not None:
+      m = re.match(r'^([0-9]+)/([0-9]+)$', args.shard)
+      if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        parser.error("argument -shard: value must be a shard number and the number of shards, e.g. 1/4")
+
+      if args.pv is not None:
+        parser.error("argument -pv: not allowed with argument -shard")
+
+      args.shard = (int(m.group(1)), int(m.group(2)), args.stateless)
+
+    elif args.pv is not None and args.pv < 1:
+      parser.error("argument -pv: value must be at least 1")
+
+    elif args.stateless is True:
+      parser.error("argument -stateless: only allowed with argument -shard")
+
+    if args.merge is not None:
+      for a in ('d', 'g', 'o', 'dc', 'pv', 'shard'):
+        if getattr(args, a) is not None:
+          parser.error("argument -" + a + ": not allowed with argument -merge")
+
     if args.od is not None and not os.access(args.od, os.W_OK):
       parser.error("argument -od: unable to write to output directory")
 
+    if args.dc is not None:
+      if not os.path.isdir(args.dc):
+        os.makedirs(args.dc)
+
+      if not os.access(args.dc, os.W_OK):
+        parser.error("argument -dc: unable to write to cache directory")
+
     data = None
+    datasets = {}
     vault = [ None ]
     gvars = {}
     dt = {}
@@ -152,14 +218,20 @@ def main():
         if 'data' in dt:
           data = dt['data']
 
+        if 'datasets' in dt:
+          datasets.update(dt['datasets'])
+
         if 'vars' in dt:
           gyaml = decrypt_vault(dt['vars'])
           if gyaml:
             gvars.update(yaml.load(gyaml, Loader=yaml.SafeLoader))
 
-    if args.d is not None:
-      with open(args.d.name) as f:
-        data = f.read()
+    for name, d in dfiles.items():
+      with open(d) as f:
+        if name is None:
+          data = f.read()
+        else:
+          datasets[name] = f.read()
 
     if args.g is not None:
       for g in args.g:
@@ -173,13 +245,42 @@ def main():
     if args.o is None:
       args.o = '_stdout_'
 
-    import_filters()
-    outputs = JinjaFx().jinjafx(args.t, data, gvars, args.o)
+    if args.merge is not None:
+      outputs = merge_shards(args.merge)
+
+    else:
+      import_filters()
+      jfx = JinjaFx()
+
+      if args.shard is not None:
+        if hasattr(args.t, 'name'):
+          with open(args.t.name) as f:
+            template = f.read()
+        else:
+          template = args.t
+
+        skey = json.dumps([ template, args.o, data, gvars, datasets, args.stateless ], sort_keys=True, default=str)
+
+      if args.dc is not None and data:
+        data = cached_dataset(args.dc, data, gvars, args.pv)
+
+      outputs = jfx.jinjafx(args.t, data, gvars, args.o, args.pv, None, datasets, None, args.shard)
+
     ocount = 0
 
     if args.od is not None:
       os.chdir(args.od)
 
+    if args.shard is not None:
+      manifest = dict(jfx.g_stats['shard'], version=__version__, total=jfx.g_stats['total'], stateless=args.stateless, key=hashlib.sha256(skey.encode('utf-8')).hexdigest())
+      sfile = 'jfx_shard_' + str(args.shard[0]) + '_of_' + str(args.shard[1]) + '.json'
+
+      with open(sfile, 'w') as f:
+        json.dump({ 'manifest': manifest, 'outputs': outputs }, f)
+
+      print(format_bytes(os.path.getsize(sfile)) + ' > ' + sfile + '\n')
+      return
+
     for o in sorted(outputs.items(), key=lambda x: (x[0] == '_stdout_')):
       output = '\n'.join(o[1]) + '\n'
       if len(output.strip()) > 0:
@@ -208,6 +309,9 @@ def main():
     else:
       raise Exception('nothing to output')
 
+    if args.merge is None and jfx.g_stats['truncated'] and '-q' not in sys.argv:
+      print('preview: rendered ' + str(jfx.g_stats['rows']) + ' of ' + ('~' if jfx.g_stats['estimated'] else '') + str(jfx.g_stats['total']) + ' rows', file=sys.stderr)
+
   except KeyboardInterrupt:
     sys.exit(-1)
 
@@ -230,24 +334,163 @@ def format_bytes(b):
       return '{:.2f}'.format(b).rstrip('0').rstrip('.') + u + 'B'
 
 
+class JinjaFxDataset():
+  def __init__(self, rows, total=None, estimated=False, memory=None):
+    self.rows = rows
+    self.total = max(0, len(rows) - 1) if total is None else total
+    self.estimated = estimated
+    self.memory = sum([ sum([ len(str(f)) + 8 for f in r ]) for r in rows ]) if memory is None else memory
+    self.index = {}
+
+
+def cached_dataset(directory, data, gvars, limit=None):
+  dopts = json.dumps([ __version__, list(sys.version_info[:2]), limit ] + [ gvars.get(k) for k in ('jinjafx_adjust_headers', 'jinjafx_filter', 'jinjafx_sort') ], sort_keys=True, default=str)
+  dkey = hashlib.sha256(dopts.encode('utf-8') + b'\0' + data.encode('utf-8')).hexdigest()
+  dfile = os.path.join(directory, 'jfx_' + dkey + '.dat')
+
+  try:
+    with open(dfile, 'rb') as f:
+      return JinjaFxDataset(*marshal.load(f))
+
+  except Exception:
+    pass
+
+  dataset = JinjaFx().prepare(data, gvars, limit)
+
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='jfx_', suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      marshal.dump((dataset.rows, dataset.total, dataset.estimated, dataset.memory), f)
+    os.rename(tmp, dfile)
+
+  except Exception:
+    os.unlink(tmp)
+    raise
+
+  return dataset
+
+
+def merge_outputs(parts):
+  if len(parts) == 1:
+    outputs = parts[0]
+  else:
+    outputs = {}
+    for p in parts:
+      for o in p:
+        if o not in outputs:
+          outputs[o] = []
+        outputs[o] += p[o]
+
+  for o in sorted(outputs.keys(), key=lambda x: int(x.split(':')[0])):
+    nkey = o.split(':')[1]
+
+    if nkey not in outputs:
+      outputs[nkey] = []
+        
+    outputs[nkey] += outputs[o]
+    del outputs[o]
+
+  return outputs
+
+
+def merge_shards(files):
+  shards = {}
+
+  for sfile in files:
+    with open(sfile) as f:
+      shard = json.load(f)
+
+    if shard['manifest']['shard'] in shards:
+      raise Exception('duplicate shard ' + str(shard['manifest']['shard']) + ' in \'' + sfile + '\'')
+
+    shards[shard['manifest']['shard']] = shard
+
+  manifest = next(iter(shards.values()))['manifest']
+
+  for shard in shards.values():
+    if shard['manifest']['key'] != manifest['key'] or shard['manifest']['shards'] != manifest['shards']:
+      raise Exception('shards were not rendered from the same template, data, vars and options')
+
+  missing = [str(i) for i in range(1, manifest['shards'] + 1) if i not in shards]
+  if missing:
+    raise Exception('missing shard ' + ', '.join(missing) + ' of ' + str(manifest['shards']))
+
+  return merge_outputs([shards[i]['outputs'] for i in range(1, manifest['shards'] + 1)])
+
+
+class JinjaFxPlan():
+  def __init__(self, template, output='_stdout_', extensions=[]):
+    jinja2_options = {
+      'undefined': jinja2.StrictUndefined,
+      'trim_blocks': True,
+      'lstrip_blocks': True,
+      'keep_trailing_newline': True
+    }
+
+    if isinstance(template, bytes) or isinstance(template, str):
+      self.env = jinja2.Environment(extensions=extensions, **jinja2_options)
+      [self.env.filters.update(f) for f in jinja2_filters]
+      if isinstance(template, bytes):
+        self.template = self.env.from_string(template.decode('utf-8'))
+      else:
+        self.template = self.env.from_string(template)
+    else:
+      self.env = jinja2.Environment(extensions=extensions, loader=jinja2.FileSystemLoader(os.path.dirname(template.name)), **jinja2_options)
+      [self.env.filters.update(f) for f in jinja2_filters]
+      self.template = self.env.get_template(os.path.basename(template.name))
+
+    self.output = self.env.from_string(output)
+
+
+  def render(self, data, gvars, limit_rows=None, limit_bytes=None, datasets=None, max_memory=None, shard=None, stream=None):
+    jfx = JinjaFx()
+    return jfx.jinjafx(self, data, gvars, None, limit_rows, limit_bytes, datasets, max_memory, shard, stream), jfx.g_stats
+
+
 class JinjaFx():
-  def jinjafx(self, template, data, gvars, output):
+  expand_cache_size = 1024
+  expand_cache_limit = 65536
+
+  def __init__(self):
+    self.g_expand = collections.OrderedDict()
+
+
+  def prepare(self, data, gvars, limit=None, max_memory=None):
     self.g_datarows = []
     self.g_dict = {}
     self.g_row = 0 
+    self.g_memory = 0
+    self.g_peak = 0
+    self.g_max_memory = self.jfx_max_memory(gvars, max_memory)
 
-    outputs = {}
     delim = None
     rowkey = 1
     int_indices = []
+    skipped = 0
+    lines = 0
+
+    if 'jinjafx_sort' in gvars and len(gvars['jinjafx_sort']) > 0:
+      elimit = None
+    else:
+      elimit = limit
     
+    # str and bytes are both split on universal newlines ('\n', '\r' or '\r\n') - str.splitlines() would also split on '\x0b', '\x0c', '\u2028', etc
     if isinstance(data, bytes):
-      data = data.decode('utf-8')
+      data = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+    elif hasattr(data, 'splitlines'):
+      data = io.StringIO(data, newline=None)
 
-    if data is not None and len(data.strip()) > 0:
+    if data is not None:
       jinjafx_filter = {}
+      nonblank = False
+
+      for l in data:
+        l = l.rstrip('\r\n')
+
+        if len(l.strip()) > 0:
+          nonblank = True
 
-      for l in data.splitlines():
         if len(l.strip()) > 0 and not re.match(r'^[ \t]*#', l):
           if len(self.g_datarows) == 0:
             if l.count(',') > l.count('\t'):
@@ -289,12 +532,17 @@ class JinjaFx():
               raise Exception('duplicate header field detected in data')
             else:
               self.g_datarows.append(fields)
+              self.jfx_memory(sum([ len(f) + 8 for f in fields ]), 'parsing data')
 
             if 'jinjafx_filter' in gvars and len(gvars['jinjafx_filter']) > 0:
               for field in gvars['jinjafx_filter']:
                 jinjafx_filter[self.g_datarows[0].index(field) + 1] = gvars['jinjafx_filter'][field]
 
+          elif elimit is not None and len(self.g_datarows) > elimit:
+            skipped += 1
+
           else:
+            lines += 1
             gcount = 1
             fields = []
             for f in re.split(delim, l.strip(schars)):
@@ -364,10 +612,11 @@ class JinjaFx():
 
                 if include_row:
                   self.g_datarows.append(fields[row])
+                  self.jfx_memory(sum([ len(str(f)) + 8 for f in fields[row] ]), 'parsing data')
 
                 row += 1
 
-      if len(self.g_datarows) <= 1:
+      if nonblank and len(self.g_datarows) <= 1:
         raise Exception('not enough data rows - need at least two')
 
     if 'jinjafx_sort' in gvars and len(gvars['jinjafx_sort']) > 0:
@@ -386,29 +635,65 @@ class JinjaFx():
           r = True if field.startswith('-') else False
           self.g_datarows[1:] = sorted(self.g_datarows[1:], key=lambda n: n[self.g_datarows[0].index(field.lstrip('+-')) + 1], reverse=r)
 
+    total = max(0, len(self.g_datarows) - 1)
+
+    # skipped lines haven't been expanded, so assume they expand like the lines which have been
+    if skipped > 0:
+      total += int(round(skipped * float(total) / max(lines, 1)))
+
+    if limit is not None and len(self.g_datarows) > limit + 1:
+      self.g_memory -= sum([ sum([ len(str(f)) + 8 for f in r ]) for r in self.g_datarows[limit + 1:] ])
+      self.g_datarows[limit + 1:] = []
+
+    return JinjaFxDataset(self.g_datarows, total, skipped > 0, self.g_memory)
+
+
+  def jinjafx(self, template, data, gvars, output, limit_rows=None, limit_bytes=None, datasets=None, max_memory=None, shard=None, stream=None):
+    if not isinstance(data, JinjaFxDataset):
+      data = self.prepare(data, gvars, limit_rows, max_memory)
+      prepare_peak = self.g_peak
+    else:
+      prepare_peak = data.memory
+
+    self.g_datasets = {}
+
+    if datasets is not None:
+      for name in datasets:
+        if isinstance(datasets[name], JinjaFxDataset):
+          self.g_datasets[name] = datasets[name]
+        else:
+          try:
+            self.g_datasets[name] = JinjaFx().prepare(datasets[name], { k: gvars[k] for k in ['jinjafx_adjust_headers', 'jinjafx_max_memory'] if k in gvars }, None, max_memory)
+          except Exception as e:
+            e.args = ((str(e.args[0]) if len(e.args) > 0 else '') + ' in dataset \'' + name + '\'',) + e.args[1:]
+            raise
+
+    self.g_dataset = data
+    self.g_datarows = data.rows
+    self.g_dict = {}
+    self.g_row = 0
+    self.g_stats = { 'rows': 0, 'total': data.total, 'estimated': data.estimated, 'truncated': False }
+    self.g_memory = 0
+    self.g_peak = 0
+    self.g_max_memory = self.jfx_max_memory(gvars, max_memory)
+
+    self.jfx_memory(data.memory + 8 * sum([ len(r) for r in data.rows ]) + sum([ d.memory for d in self.g_datasets.values() ]), 'rendering')
+
+    outputs = {}
+    nbytes = 0
+
     if 'jinja2_extensions' not in gvars:
       gvars.update({ 'jinja2_extensions': [] })
 
-    jinja2_options = {
-      'undefined': jinja2.StrictUndefined,
-      'trim_blocks': True,
-      'lstrip_blocks': True,
-      'keep_trailing_newline': True
-    }
+    if not isinstance(template, JinjaFxPlan):
+      template = JinjaFxPlan(template, output, gvars['jinja2_extensions'])
 
-    if isinstance(template, bytes) or isinstance(template, str):
-      env = jinja2.Environment(extensions=gvars['jinja2_extensions'], **jinja2_options)
-      [env.filters.update(f) for f in jinja2_filters]
-      if isinstance(template, bytes):
-        template = env.from_string(template.decode('utf-8'))
-      else:
-        template = env.from_string(template)
-    else:
-      env = jinja2.Environment(extensions=gvars['jinja2_extensions'], loader=jinja2.FileSystemLoader(os.path.dirname(template.name)), **jinja2_options)
-      [env.filters.update(f) for f in jinja2_filters]
-      template = env.get_template(os.path.basename(template.name))
+    plan = template
+    env = plan.env
+    template = plan.template
 
-    env.globals.update({ 'jinjafx': {
+    g = dict(template.globals)
+    g.update({ 'jinjafx': {
       'version': __version__,
       'jinja_version': jinja2.__version__,
       'expand': self.jfx_expand,
@@ -417,42 +702,71 @@ class JinjaFx():
       'first': self.jfx_first,
       'last': self.jfx_last,
       'fields': self.jfx_fields,
+      'group': self.jfx_group,
+      'lookup': self.jfx_lookup,
       'setg': self.jfx_setg,
       'getg': self.jfx_getg,
       'nslookup': self.jfx_nslookup,
       'rows': max([0, len(self.g_datarows) - 1]),
-      'data': [r[1:] if isinstance(r[0], int) else r for r in self.g_datarows]
+      'data': [r[1:] if isinstance(r[0], int) else list(r) for r in self.g_datarows]
     }})
 
     if len(gvars) > 0:
-      env.globals.update(gvars)
+      g.update(gvars)
+
+    def render(t, rowdata):
+      ctx = jinja2.runtime.new_context(env, t.name, t.blocks, rowdata, False, g)
+      try:
+        return env.concat(t.root_render_func(ctx))
+      except Exception:
+        env.handle_exception()
+
+    if shard is not None:
+      nrows = max(1, len(self.g_datarows) - 1)
+      shard_start = 1 + nrows * (shard[0] - 1) // shard[1]
+      shard_end = 1 + nrows * shard[0] // shard[1]
+      self.g_stats['shard'] = { 'shard': shard[0], 'shards': shard[1], 'start': shard_start, 'end': shard_end - 1 }
 
     for row in range(1, max(2, len(self.g_datarows))):
+      if (limit_rows is not None and row > limit_rows) or (limit_bytes is not None and nbytes >= limit_bytes):
+        break
+
+      if shard is not None:
+        if row >= shard_end or shard_start == shard_end:
+          break
+
+        if row < shard_start and len(shard) > 2 and shard[2]:
+          continue
+
+      collect = shard is None or row >= shard_start
+
       rowdata = {}
 
       if len(self.g_datarows) > 0:
         for col in range(len(self.g_datarows[0])):
           rowdata.update({ self.g_datarows[0][col]: self.g_datarows[row][col + 1] })
 
-        env.globals['jinjafx'].update({ 'row': row })
+        g['jinjafx'].update({ 'row': row })
         self.g_row = row
 
       else:
-        env.globals['jinjafx'].update({ 'row': 0 })
+        g['jinjafx'].update({ 'row': 0 })
         self.g_row = 0
 
       try:
-        content = template.render(rowdata)
+        content = render(template, rowdata)
+        nbytes += len(content)
 
       except Exception as e:
-        if e.args[0].startswith('[jfx_exception] '):
+        if len(e.args) >= 1 and str(e.args[0]).startswith('[jfx_exception] '):
           e.args = (e.args[0][16:],)
         else:
           if len(e.args) >= 1 and self.g_row != 0:
             e.args = (e.args[0] + ' at data row ' + str(self.g_datarows[row][0]) + ':\n - ' + str(rowdata),) + e.args[1:]
         raise
 
-      stack = ['0:' + env.from_string(output).render(rowdata)]
+      stack = ['0:' + render(plan.output, rowdata)]
+      rowoutputs = {}
       for l in iter(content.splitlines()):
         block_begin = re.search(r'<output[\t ]+["\']*(.+?)["\']*[\t ]*>(?:\[(-?\d+)\])?', l, re.IGNORECASE)
         if block_begin:
@@ -469,24 +783,54 @@ class JinjaFx():
               stack.pop()
             else:
               raise Exception('unbalanced output tags')
-          else:
+          elif collect:
             if stack[-1] not in outputs:
               outputs[stack[-1]] = []
             outputs[stack[-1]].append(l)
+            self.jfx_memory(len(l) + 8, 'rendering')
+
+            if stream is not None:
+              if stack[-1] not in rowoutputs:
+                rowoutputs[stack[-1]] = []
+              rowoutputs[stack[-1]].append(l)
 
       if len(stack) != 1:
         raise Exception('unbalanced output tags')
 
-    for o in sorted(outputs.keys(), key=lambda x: int(x.split(':')[0])):
-      nkey = o.split(':')[1]
+      if stream is not None and len(rowoutputs) > 0:
+        stream(rowoutputs)
+
+      if collect:
+        self.g_stats['rows'] = self.g_row if shard is None else self.g_row - shard_start + 1
 
-      if nkey not in outputs:
-        outputs[nkey] = []
-          
-      outputs[nkey] += outputs[o]
-      del outputs[o]
+    self.g_stats['truncated'] = shard is None and self.g_stats['rows'] < data.total
+    self.g_stats['memory'] = { 'prepare': prepare_peak, 'render': self.g_peak }
 
-    return outputs
+    return outputs if shard is not None else merge_outputs([outputs])
+
+
+  def jfx_max_memory(self, gvars, max_memory=None):
+    budget = gvars.get('jinjafx_max_memory')
+
+    if budget is not None:
+      m = re.match(r'(?i)^([0-9]+)([KMG]?)B?$', str(budget).strip())
+      if not m:
+        raise Exception('invalid value specified for \'jinjafx_max_memory\' - must be a size in bytes, e.g. 262144, 256K or 64M')
+
+      budget = int(m.group(1)) * { '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }[m.group(2).upper()]
+
+    if max_memory is not None and (budget is None or max_memory < budget):
+      budget = max_memory
+
+    return budget
+
+
+  def jfx_memory(self, nbytes, phase):
+    self.g_memory += nbytes
+    self.g_peak = max(self.g_peak, self.g_memory)
+
+    if self.g_max_memory is not None and self.g_memory > self.g_max_memory:
+      raise Exception('memory budget of ' + format_bytes(self.g_max_memory) + ' exceeded while ' + phase + ' (' + format_bytes(self.g_memory) + ' in use)')
 
 
   def jfx_data_counter(self, m, orow, col, row):
@@ -503,98 +847,145 @@ class JinjaFx():
     return str(self.g_dict[key]).zfill(pad)
 
 
-  def jfx_expand(self, s, rg=False):
-    pofa = [s]
-    groups = [[s]]
+  def jfx_expand(self, s, rg=False, lazy=False):
+    if lazy:
+      return self.jfx_expand_lazy(s)
 
-    if re.search(r'(?<!\\)[\(\[\{]', pofa[0]):
-      i = 0
-      while i < len(pofa):
-        m = re.search(r'(?<!\\)\((.+?)(?<!\\)\)', pofa[i])
-        if m:
-          for g in re.split(r'(?<!\\)\|', m.group(1)):
-            pofa.append(pofa[i][:m.start(1) - 1] + g + pofa[i][m.end(1) + 1:])
-            groups.append(groups[i] + [re.sub(r'\\([\|\(\[\)\]])', r'\1', g)])
+    if not rg:
+      pofa = self.g_expand.pop(s, None)
 
-          pofa.pop(i)
-          groups.pop(i)
+      if pofa is None:
+        pofa = tuple(self.jfx_expand(s, True)[0])
 
-        else:
-          i += 1
+        if len(self.g_expand) >= self.expand_cache_size:
+          self.g_expand.popitem(last=False)
 
-      i = 0
-      while i < len(pofa):
-        m = re.search(r'(?<!\\)\{[ \t]*([0-9]+-[0-9]+):([0-9]+)(?::([0-9]+))?[ \t]*(?<!\\)\}', pofa[i])
-        if m:
-          mpos = groups[i][0].index(m.group())
-          nob = len(re.findall(r'(?<!\\)\(', groups[i][0][:mpos]))
-          ncb = len(re.findall(r'(?<!\\)\)', groups[i][0][:mpos]))
-          groups[i][0] = groups[i][0].replace(m.group(), 'x', 1)
-          group = max(0, (nob - ncb) * nob)
+      if len(pofa) <= self.expand_cache_limit:
+        self.g_expand[s] = pofa
 
-          e = list(map(int, m.group(1).split('-')))
+      return list(pofa)
 
-          start = e[0]
-          end = e[1] + 1 if e[1] >= e[0] else e[1] - 1
-          step = int(m.group(2)) if end > start else 0 - int(m.group(2))
+    items = [(s, [s])]
 
-          for n in range(start, end, step):
-            n = str(n).zfill(int(m.group(3)) if m.lastindex == 3 else 0)
-            pofa.append(pofa[i][:m.start(1) - 1] + n + pofa[i][m.end(m.lastindex) + 1:])
+    if expand_any_re.search(s):
+      for phase in (1, 2):
+        queue = collections.deque(items)
+        items = []
 
-            ngroups = list(groups[i])
-            if group > 0 and group < len(ngroups):
-              ngroups[group] = ngroups[group].replace(m.group(), n, 1)
+        while queue:
+          p, g = queue.popleft()
+          children = self.jfx_expand_children(p, g, phase)
 
-            groups.append(ngroups)
+          if children is None:
+            items.append((p, g))
+          else:
+            queue.extend(children)
 
-          pofa.pop(i)
-          groups.pop(i)
+    pofa = [expand_unescape_re.sub(r'\1', p) for p, g in items]
+    return [pofa, [g[1:] for p, g in items]]
 
-        else:
-          m = re.search(r'(?<!\\)\[([A-Z0-9\-]+)(?<!\\)\]', pofa[i], re.IGNORECASE)
-          if m and not re.match(r'(?:[A-Z]-[^A-Z]|[a-z]-[^a-z]|[0-9]-[^0-9]|[^A-Za-z0-9]-)', m.group(1)):
-            clist = []
-  
-            mpos = groups[i][0].index(m.group())
-            nob = len(re.findall(r'(?<!\\)\(', groups[i][0][:mpos]))
-            ncb = len(re.findall(r'(?<!\\)\)', groups[i][0][:mpos]))
-            groups[i][0] = groups[i][0].replace(m.group(), 'x', 1)
-            group = max(0, (nob - ncb) * nob)
-  
-            for x in re.findall('([A-Z0-9](-[A-Z0-9])?)', m.group(1), re.IGNORECASE):
-              if x[1] != '':
-                e = x[0].split('-')
 
-                start = ord(e[0])
-                end = ord(e[1]) + 1 if ord(e[1]) >= ord(e[0]) else ord(e[1]) - 1
-                step = 1 if end > start else -1
+  def jfx_expand_lazy(self, s):
+    if not expand_any_re.search(s):
+      yield expand_unescape_re.sub(r'\1', s)
+      return
 
-                for c in range(start, end, step):
-                  clist.append(chr(c))
-              else:
-                clist.append(x[0])
-  
-            for c in clist:
-              pofa.append(pofa[i][:m.start(1) - 1] + c + pofa[i][m.end(1) + 1:])
-              ngroups = list(groups[i])
-  
-              if group > 0 and group < len(ngroups):
-                ngroups[group] = ngroups[group].replace(m.group(), c, 1)
-              
-              groups.append(ngroups)
-  
-            pofa.pop(i)
-            groups.pop(i)
+    roots = lambda: self.jfx_expand_levels(lambda: iter([(s, [s])]), 1)
+
+    for p, g in self.jfx_expand_levels(roots, 2):
+      yield expand_unescape_re.sub(r'\1', p)
+
+
+  def jfx_expand_levels(self, roots, phase):
+    # the eager expansion is breadth first, so yield the permutations that are complete at each depth
+    # in turn - each depth walks the tree again depth first, so only the current path is held in memory
+    depth = 0
+    found = True
+
+    while found:
+      found = False
+
+      for root in roots():
+        stack = [iter([root])]
+
+        while stack:
+          item = next(stack[-1], None)
+
+          if item is None:
+            stack.pop()
 
           else:
-            i += 1
+            children = self.jfx_expand_children(item[0], item[1], phase)
+
+            if len(stack) - 1 == depth:
+              found = True
+              if children is None:
+                yield item
+
+            elif children is not None:
+              stack.append(children)
+
+      depth += 1
 
-    for g in groups:
-      g.pop(0)
 
-    pofa = [re.sub(r'\\([\|\(\[\)\]])', r'\1', i) for i in pofa]
-    return [pofa, groups] if rg else pofa
+  def jfx_expand_children(self, p, g, phase):
+    if phase == 1:
+      m = expand_group_re.search(p)
+      if m:
+        return ((p[:m.start(1) - 1] + a + p[m.end(1) + 1:], g + [expand_unescape_re.sub(r'\1', a)]) for a in expand_alt_re.split(m.group(1)))
+
+      return None
+
+    m = expand_counter_re.search(p)
+    if m:
+      group = self.jfx_expand_group(m, g)
+      e = list(map(int, m.group(1).split('-')))
+
+      start = e[0]
+      end = e[1] + 1 if e[1] >= e[0] else e[1] - 1
+      step = int(m.group(2)) if end > start else 0 - int(m.group(2))
+      pad = int(m.group(3)) if m.lastindex == 3 else 0
+
+      return self.jfx_expand_values(p, g, m, m.end(m.lastindex) + 1, group, (str(n).zfill(pad) for n in range(start, end, step)))
+
+    m = expand_class_re.search(p)
+    if m and not expand_range_re.match(m.group(1)):
+      group = self.jfx_expand_group(m, g)
+      clist = []
+
+      for x in expand_chars_re.findall(m.group(1)):
+        if x[1] != '':
+          e = x[0].split('-')
+
+          start = ord(e[0])
+          end = ord(e[1]) + 1 if ord(e[1]) >= ord(e[0]) else ord(e[1]) - 1
+          step = 1 if end > start else -1
+
+          for c in range(start, end, step):
+            clist.append(chr(c))
+        else:
+          clist.append(x[0])
+
+      return self.jfx_expand_values(p, g, m, m.end(1) + 1, group, clist)
+
+    return None
+
+
+  def jfx_expand_group(self, m, g):
+    mpos = g[0].index(m.group())
+    nob = len(expand_ob_re.findall(g[0], 0, mpos))
+    ncb = len(expand_cb_re.findall(g[0], 0, mpos))
+    g[0] = g[0].replace(m.group(), 'x', 1)
+    return max(0, (nob - ncb) * nob)
+
+
+  def jfx_expand_values(self, p, g, m, end, group, values):
+    for v in values:
+      ngroups = list(g)
+      if group > 0 and group < len(ngroups):
+        ngroups[group] = ngroups[group].replace(m.group(), v, 1)
+
+      yield (p[:m.start(1) - 1] + v + p[end:], ngroups)
 
 
   def jfx_fandl(self, forl, fields, ffilter):
@@ -686,6 +1077,83 @@ class JinjaFx():
     
     return field_values
 
+
+  def jfx_group(self, fields, values=None, columns=None):
+    if len(self.g_datarows) == 0:
+      return []
+
+    fields = [fields] if isinstance(fields, str) else list(fields)
+    fpos = []
+
+    for f in fields:
+      if f in self.g_datarows[0]:
+        fpos.append(self.g_datarows[0].index(f) + 1)
+      else:
+        raise Exception('invalid field \'' + f + '\' passed to jinjafx.group()')
+
+    if values is None:
+      if self.g_row == 0:
+        return []
+      key = tuple([self.g_datarows[self.g_row][i] for i in fpos])
+    else:
+      key = tuple([values] if isinstance(values, (str, int)) else values)
+
+    rows = self.jfx_index(self.g_dataset, fields, fpos).get(key, [])
+
+    if columns is None:
+      return [dict(zip(self.g_datarows[0], self.g_datarows[r][1:])) for r in rows]
+
+    if isinstance(columns, str):
+      if columns in self.g_datarows[0]:
+        cpos = self.g_datarows[0].index(columns) + 1
+      else:
+        raise Exception('invalid field \'' + columns + '\' passed to jinjafx.group()')
+      return [self.g_datarows[r][cpos] for r in rows]
+
+    cpos = []
+    for c in columns:
+      if c in self.g_datarows[0]:
+        cpos.append(self.g_datarows[0].index(c) + 1)
+      else:
+        raise Exception('invalid field \'' + c + '\' passed to jinjafx.group()')
+    return [[self.g_datarows[r][i] for i in cpos] for r in rows]
+
+
+  def jfx_lookup(self, dataset, field, value, column=None):
+    if dataset in self.g_datasets:
+      rows = self.g_datasets[dataset].rows
+    else:
+      raise Exception('invalid dataset \'' + str(dataset) + '\' passed to jinjafx.lookup()')
+
+    if len(rows) == 0:
+      return None
+
+    for f in [field] if column is None else [field, column]:
+      if f not in rows[0]:
+        raise Exception('invalid field \'' + f + '\' passed to jinjafx.lookup()')
+
+    r = self.jfx_index(self.g_datasets[dataset], [field], [rows[0].index(field) + 1]).get((value,))
+
+    if r is None:
+      return None
+    elif column is None:
+      return dict(zip(rows[0], rows[r[0]][1:]))
+    else:
+      return rows[r[0]][rows[0].index(column) + 1]
+
+
+  def jfx_index(self, dataset, fields, fpos):
+    index = dataset.index.get(tuple(fields))
+
+    if index is None:
+      index = {}
+      for r in range(1, len(dataset.rows)):
+        index.setdefault(tuple([dataset.rows[r][i] for i in fpos]), []).append(r)
+      dataset.index[tuple(fields)] = index
+      dataset.memory += sum([ sum([ len(str(f)) + 8 for f in k ]) + 8 * len(v) + 8 for k, v in index.items() ])
+
+    return index
+
  
   def jfx_counter(self, key=None, increment=1, start=1):
     if key is None:
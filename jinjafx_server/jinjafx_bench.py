@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+# JinjaFx Server Benchmark - Jinja Templating Tool
+# Copyright (c) 2020-2021 Chris Mason <chris@jinjafx.org>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from __future__ import print_function
+import jinjafx, sys, re, time, argparse, json, base64, random, threading, http.client
+
+endpoints = [ 'jinjafx', 'dt', 'get_link', 'download' ]
+
+template = '''{% set hostname = host | lower %}
+hostname {{ hostname }}
+!
+interface {{ interface }}
+ description {{ description }}
+ ip address {{ ip }} 255.255.255.0
+!
+'''
+
+class JinjaFxBench():
+  def __init__(self, host, port, mix, rows):
+    self.host = host
+    self.port = port
+    self.mix = mix
+    self.lock = threading.Lock()
+    self.results = { e: [] for e in endpoints }
+    self.errors = { e: {} for e in endpoints }
+
+    data = [ 'host,interface,description,ip' ]
+    for i in range(rows):
+      data.append('R' + str(i % 100) + ',GigabitEthernet0/' + str(i) + ',Link ' + str(i) + ' to Core,10.' + str(i // 65536 % 256) + '.' + str(i // 256 % 256) + '.' + str(i % 256))
+
+    self.dt = json.dumps({
+      'template': base64.b64encode(template.encode('utf-8')).decode('utf-8'),
+      'data': base64.b64encode(('\n'.join(data) + '\n').encode('utf-8')).decode('utf-8'),
+      'vars': base64.b64encode(b'---\nversion: 1\n').decode('utf-8')
+    }).encode('utf-8')
+
+    self.link = None
+    self.outputs = None
+
+
+  def request(self, conn, method, path, body=None):
+    headers = { 'Content-Type': 'application/json' } if body is not None else {}
+    conn.request(method, path, body, headers)
+    r = conn.getresponse()
+    return r.status, r.read()
+
+
+  def prepare(self):
+    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+    status, body = self.request(conn, 'POST', '/jinjafx', self.dt)
+    if status != 200:
+      raise Exception("'/jinjafx' returned " + str(status))
+
+    jsr = json.loads(body.decode('utf-8'))
+    if jsr['status'] != 'ok':
+      raise Exception(jsr['error'])
+
+    self.outputs = json.dumps(jsr['outputs']).encode('utf-8')
+
+    if self.mix.get('dt', 0) > 0 or self.mix.get('get_link', 0) > 0:
+      status, body = self.request(conn, 'POST', '/get_link', self.dt)
+      if status != 200:
+        raise Exception("'/get_link' returned " + str(status) + " - the server must be started with '-r' or '-s3'")
+
+      self.link = body.decode('utf-8').strip()
+
+    conn.close()
+
+
+  def next_request(self, rnd):
+    e = rnd.choices(list(self.mix.keys()), list(self.mix.values()))[0]
+
+    if e == 'jinjafx':
+      return e, 'POST', '/jinjafx', self.dt
+    elif e == 'dt':
+      return e, 'GET', '/dt/' + self.link, None
+    elif e == 'get_link':
+      return e, 'POST', '/get_link', self.dt
+    else:
+      return e, 'POST', '/download', self.outputs
+
+
+  def worker(self, stop, schedule):
+    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+    rnd = random.Random()
+
+    while True:
+      if schedule is not None:
+        st = schedule()
+        if st is None:
+          break
+
+        if st > time.perf_counter():
+          time.sleep(st - time.perf_counter())
+
+      else:
+        st = time.perf_counter()
+        if st >= stop:
+          break
+
+      e, method, path, body = self.next_request(rnd)
+
+      try:
+        status, content = self.request(conn, method, path, body)
+
+      except (OSError, http.client.HTTPException) as ex:
+        status = type(ex).__name__
+        conn.close()
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+      elapsed = time.perf_counter() - st
+
+      with self.lock:
+        if status == 200:
+          self.results[e].append(elapsed)
+        else:
+          self.errors[e][str(status)] = self.errors[e].get(str(status), 0) + 1
+
+    conn.close()
+
+
+  def run(self, concurrency, duration, rate=None):
+    schedule = None
+    start = time.perf_counter()
+    stop = start + duration
+
+    if rate is not None:
+      slots = iter(range(int(rate * duration)))
+      slock = threading.Lock()
+
+      def schedule():
+        with slock:
+          n = next(slots, None)
+        return None if n is None else start + n / rate
+
+    threads = [ threading.Thread(target=self.worker, args=(stop, schedule)) for i in range(concurrency) ]
+
+    for t in threads:
+      t.start()
+
+    for t in threads:
+      t.join()
+
+    return time.perf_counter() - start
+
+
+def percentile(values, p):
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0
+
+
+def report(bench, elapsed):
+  print(' ' + 'endpoint'.ljust(12) + 'requests'.rjust(10) + 'errors'.rjust(10) + 'req/s'.rjust(10) + 'p50'.rjust(10) + 'p95'.rjust(10) + 'p99'.rjust(10) + 'max'.rjust(10))
+
+  total = []
+  terrors = 0
+
+  for e in endpoints + [ 'total' ]:
+    if e == 'total':
+      results = sorted(total)
+      errors = terrors
+    elif e in bench.mix:
+      results = sorted(bench.results[e])
+      errors = sum(bench.errors[e].values())
+      total += results
+      terrors += errors
+    else:
+      continue
+
+    line = ' ' + e.ljust(12) + str(len(results) + errors).rjust(10) + str(errors).rjust(10) + str(round(len(results) / elapsed, 1)).rjust(10)
+    for p in (50, 95, 99, 100):
+      line += (str(round(percentile(results, p) * 1000, 1)) + 'ms').rjust(10)
+
+    print(line)
+
+  for e in endpoints:
+    for status, n in sorted(bench.errors[e].items()):
+      print(' warning: ' + str(n) + ' request(s) to ' + e + ' failed with ' + status, file=sys.stderr)
+
+
+def main():
+  try:
+    print('JinjaFx Server Benchmark v' + jinjafx.__version__ + ' - Jinja Templating Tool')
+    print('Copyright (c) 2020-2021 Chris Mason <chris@jinjafx.org>\n')
+
+    parser = jinjafx.ArgumentParser(add_help=False)
+    parser.add_argument('-u', metavar='<url>', default='http://127.0.0.1:8080', type=str)
+    parser.add_argument('-m', metavar='<mix>', default='jinjafx=70,dt=20,get_link=5,download=5', type=mix)
+    parser.add_argument('-c', metavar='<concurrency>', default=8, type=int)
+    parser.add_argument('-r', metavar='<rate>', type=float)
+    parser.add_argument('-d', metavar='<duration>', default=10, type=int)
+    parser.add_argument('-n', metavar='<rows>', default='10', type=rows)
+    args = parser.parse_args()
+
+    m = re.match(r'(?i)^http://([^/:]+)(?::([0-9]+))?/?$', args.u)
+    if not m:
+      parser.error("argument -u: value must be a url, e.g. http://127.0.0.1:8080")
+
+    for n in args.n:
+      bench = JinjaFxBench(m.group(1), int(m.group(2) or 80), args.m, n)
+      bench.prepare()
+
+      print('Running for ' + str(args.d) + 's with ' + str(n) + ' data rows, ' + str(args.c) + ' connections' + (' at ' + str(args.r) + ' req/s' if args.r else '') + '...\n')
+      report(bench, bench.run(args.c, args.d, args.r))
+      print()
+
+  except KeyboardInterrupt:
+    sys.exit(-1)
+
+  except Exception as e:
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    print('error[' + str(exc_tb.tb_lineno) + ']: ' + str(e), file=sys.stderr)
+    sys.exit(-2)
+
+
+def mix(m):
+  weights = {}
+
+  for e in m.split(','):
+    e = e.split('=', 1)
+    if e[0] not in endpoints or len(e) != 2 or not e[1].isdigit():
+      raise argparse.ArgumentTypeError("value must be a mix of " + ', '.join(endpoints) + ", e.g. jinjafx=80,dt=20")
+    weights[e[0]] = int(e[1])
+
+  if sum(weights.values()) == 0:
+    raise argparse.ArgumentTypeError("at least one endpoint must have a non-zero weight")
+
+  return { e: w for e, w in weights.items() if w > 0 }
+
+
+def rows(n):
+  if not re.match(r'^[0-9]+(,[0-9]+)*$', n):
+    raise argparse.ArgumentTypeError("value must be a number of rows or a list of rows, e.g. 10 or 10,1000,10000")
+  return [ int(x) for x in n.split(',') ]
+
+
+if __name__ == '__main__':
+  main()
@@ -16,15 +16,30 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 from __future__ import print_function
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import jinjafx, os, io, sys, socket, threading, yaml, json, base64, time, datetime
-import re, argparse, zipfile, hashlib, traceback, glob, hmac, uuid
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import jinjafx, os, io, sys, socket, threading, yaml, json, base64, binascii, time, datetime
+import re, math, argparse, zipfile, tempfile, hashlib, traceback, glob, hmac, uuid, asyncio, signal, gzip, zlib
+import collections, bisect, shutil, copy, contextlib
+import multiprocessing, queue, resource
+from multiprocessing.sharedctypes import RawArray
 
 try:
   import requests
 except:
   pass
 
+try:
+  import brotli
+except:
+  brotli = None
+
+try:
+  import zstandard
+except:
+  zstandard = None
+
 try:
   from ansible.constants import DEFAULT_VAULT_ID_MATCH
   from ansible.parsing.vault import VaultLib
@@ -34,30 +49,53 @@ except:
 
 lock = threading.RLock()
 
-aws_s3_url = None
-aws_access_key = None
-aws_secret_key = None
+aws_s3 = None
 repository = None
 api_only = False
 
-rtable = {}
-rl_rate = 0
-rl_limit = 0
-
-class JinjaFxServer(HTTPServer):
-  def handle_error(self, request, client_address):
-    pass
-
+rl_link = None
+rl_jinjafx = None
+
+post_limit = 256 * 1024
+batch_limit = 64
+max_memory = None
+timeout = 30
+workers = None
+render_pool = None
+batch_executor = None
+result_cache = None
+vars_cache = None
+dataset_cache = None
+plan_cache = None
+metrics = None
+assets = {}
+
+compress_level = 6
+compress_threshold = 1024
+
+yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+json_field_re = re.compile(br'"(\w+)"\s*:\s*(?:"([^"\\]*)"|(-?[0-9]+))\s*([,}])\s*')
 
 class JinjaFxRequest(BaseHTTPRequestHandler):
   server_version = 'JinjaFx/' + jinjafx.__version__
   protocol_version = 'HTTP/1.1'
 
+  def __init__(self, rfile, wfile, client_address):
+    self.rfile = rfile
+    self.wfile = wfile
+    self.client_address = client_address
+    self.close_connection = True
+
+
+  def handle_expect_100(self):
+    return True
+
+
   def log_message(self, format, *args):
     path = self.path if hasattr(self, 'path') else ''
 
-    if not isinstance(args[0], int) and path != '/ping':
-      ansi = '32' if args[1] == '200' else '31'
+    if not isinstance(args[0], int) and path not in ('/ping', '/metrics'):
+      ansi = '32' if args[1] in ('200', '304') else '31'
       src = str(self.client_address[0])
       ctype = ''
 
@@ -72,12 +110,146 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
         log('[' + src + '] [\033[1;' + ansi + 'm' + str(args[1]) + '\033[0m] ' + str(args[2]))
           
       elif self.command == 'POST':
-        log('[' + src + '] [\033[1;' + ansi + 'm' + str(args[1]) + '\033[0m] \033[1;33m' + self.command + '\033[0m ' + path + ctype)
+        log('[' + src + '] [\033[1;' + ansi + 'm' + str(args[1]) + '\033[0m] \033[1;33m' + self.command + '\033[0m ' + path + ctype + getattr(self, 'cache', '') + getattr(self, 'compression', ''))
 
       elif self.command != None:
-        log('[' + src + '] [\033[1;' + ansi + 'm' + str(args[1]) + '\033[0m] ' + self.command + ' ' + path)
+        log('[' + src + '] [\033[1;' + ansi + 'm' + str(args[1]) + '\033[0m] ' + self.command + ' ' + path + getattr(self, 'compression', ''))
 
         
+  def send_response(self, code, message=None):
+    self.status = int(code)
+    BaseHTTPRequestHandler.send_response(self, code, message)
+
+
+  def accept_encoding(self):
+    accepted = {}
+
+    for e in self.headers.get('Accept-Encoding', '').lower().split(','):
+      e = [ x.strip() for x in e.split(';') ]
+
+      if e[0]:
+        q = 1.0
+
+        for p in e[1:]:
+          p = [ x.strip() for x in p.split('=', 1) ]
+
+          if p[0] == 'q' and len(p) > 1:
+            try:
+              q = min(max(float(p[1]), 0.0), 1.0)
+            except ValueError:
+              q = 0.0
+
+        accepted[e[0]] = q
+
+    return accepted
+
+
+  def accepts(self, accepted, e):
+    if e in accepted:
+      return accepted[e]
+
+    if '*' in accepted:
+      return accepted['*']
+
+    return 1.0 if e == 'identity' else 0.0
+
+
+  def encode_content(self, content, headers):
+    headers['Vary'] = 'Accept-Encoding'
+    accepted = self.accept_encoding()
+
+    # identity is only skipped when it has been refused ("identity;q=0" or "*;q=0"), otherwise small or incompressible content is sent as is
+    identity = self.accepts(accepted, 'identity') > 0
+
+    if len(content) >= compress_threshold or not identity:
+      encodings = [ e for e in [ 'zstd', 'br', 'gzip' ] if self.accepts(accepted, e) > 0 and (e != 'zstd' or zstandard is not None) and (e != 'br' or brotli is not None) ]
+
+      for e in sorted(encodings, key=lambda e: -self.accepts(accepted, e))[:1]:
+        if e == 'zstd':
+          ccontent = zstandard.ZstdCompressor(level=compress_level).compress(content)
+        elif e == 'br':
+          ccontent = brotli.compress(content, quality=min(compress_level, 11))
+        else:
+          ccontent = gzip.compress(content, min(compress_level, 9))
+
+        if len(ccontent) < len(content) or not identity:
+          self.compression = ' [' + e + ' ' + jinjafx.format_bytes(len(content)) + ' > ' + jinjafx.format_bytes(len(ccontent)) + ' (' + str(round(100 * len(ccontent) / max(len(content), 1), 1)) + '%)]'
+          headers['Content-Encoding'] = e
+          return ccontent
+
+    return content
+
+
+  def send_chunked(self, ctype, headers={}, compress=True):
+    compressor = None
+
+    if compress and self.accepts(self.accept_encoding(), 'gzip') > 0:
+      compressor = zlib.compressobj(min(compress_level, 9), zlib.DEFLATED, 31)
+
+    self.send_response(200)
+    self.send_header('Content-Type', ctype)
+
+    for k, v in headers.items():
+      self.send_header(k, v)
+
+    if compressor is not None:
+      self.send_header('Content-Encoding', 'gzip')
+      self.send_header('Vary', 'Accept-Encoding')
+
+    if self.request_version == 'HTTP/1.1':
+      self.send_header('Transfer-Encoding', 'chunked')
+    else:
+      self.close_connection = True
+
+    self.end_headers()
+    return JinjaFxChunkedWriter(self.wfile, self.request_version == 'HTTP/1.1', compressor)
+
+
+  def send_zip(self, outputs, headers={}):
+    lterminator = '\r\n' if 'windows' in self.headers.get('User-Agent', '').lower() else '\n'
+    fname = 'Outputs.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.zip'
+
+    headers = dict(headers)
+    headers['X-Download-Filename'] = fname
+    headers['Content-Disposition'] = 'attachment; filename="' + fname + '"'
+
+    w = self.send_chunked('application/zip', headers, False)
+
+    with zipfile.ZipFile(w, 'w', zipfile.ZIP_DEFLATED, compresslevel=min(compress_level, 9)) as z:
+      for o, output in outputs.items():
+        ofile = re.sub(r'_+', '_', re.sub(r'[^A-Za-z0-9_. -/]', '_', os.path.normpath(o)))
+        output = output.replace('\r\n', '\n')
+
+        if lterminator != '\n':
+          output = output.replace('\n', lterminator)
+
+        if '.' not in ofile:
+          if re.search(r'<html.*?>[\s\S]+<\/html>', output, re.IGNORECASE):
+            ofile += '.html'
+          else:
+            ofile += '.txt'
+
+        z.writestr(ofile, output.encode('utf-8'))
+
+    w.close()
+
+
+  def remote_addr(self):
+    return self.headers.get('X-Forwarded-For', str(self.client_address[0]))
+
+
+  def rate_limited(self, limiter, headers, tokens=1):
+    if limiter is not None:
+      retry = limiter.acquire(self.remote_addr(), tokens)
+
+      if retry > 0:
+        headers['Retry-After'] = str(retry)
+        metrics.inc('jinjafx_rate_limited_total', path=self.path.split('?', 1)[0])
+        return True
+
+    return False
+
+
   def encode_link(self, bhash):
     alphabet = b'rpshnaf39wBUDNEGHJKLM4PQRST7VWXYZ2bcdeCg65jkm8oFqi1tuvAxyz'
     string = ''
@@ -96,34 +268,38 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
   def do_GET(self):
     fpath = self.path.split('?', 1)[0]
     readonly = None
+    headers = {}
 
     if fpath == '/ping':
       r = [ 'text/plain', 200, 'OK\r\n'.encode('utf-8') ]
 
-    elif not api_only:
-      base = os.path.abspath(os.path.dirname(sys.argv[0]))
+      if workers is not None:
+        healthy = len([w for w in workers if (time.time() - w) < (timeout * 2)])
+        self.healthy = str(healthy) + '/' + str(len(workers))
+
+    elif fpath == '/metrics':
+      r = [ 'text/plain; version=0.0.4', 200, self.encode_content(jinjafx_metrics().encode('utf-8'), headers) ]
 
+    elif not api_only:
       if fpath == '/':
         fpath = '/index.html'
 
       if re.search(r'^/dt/[A-Za-z0-9_-]{1,24}$', fpath):
         readonly = False
 
-        if aws_s3_url:
+        if aws_s3 or repository:
           try:
-            rr = aws_s3_get(aws_s3_url, 'jfx_' + fpath[4:] + '.yml')
-
-            if rr.status_code == 200:
-              r = [ 'application/yaml', 200, rr.text.encode('utf-8') ]
+            st = time.perf_counter()
+            status, content, readonly = (aws_s3 or repository).get_dt(fpath[4:])
+            metrics.observe('jinjafx_storage_duration_seconds', time.perf_counter() - st, backend='s3' if aws_s3 else 'file', op='get')
 
-              rr = aws_s3_get(aws_s3_url, 'jfx_' + fpath[4:] + '.yml.lock')
-              if rr.status_code == 200:
-                readonly = True
+            if status == 200:
+              r = [ 'application/yaml', 200, self.encode_content(content, headers) ]
 
-            elif rr.status_code == 403:
+            elif status == 403:
               r = [ 'text/plain', 403, '403 Forbidden\r\n'.encode('utf-8') ]
 
-            elif rr.status_code == 404:
+            elif status == 404:
               r = [ 'text/plain', 404, '404 Not Found\r\n'.encode('utf-8') ]
 
             else:
@@ -133,52 +309,30 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
             traceback.print_exc()
             r = [ 'text/plain', 500, '500 Internal Server Error\r\n'.encode('utf-8') ]
 
-        elif repository:
-          fpath = os.path.normpath(repository + '/jfx_' + fpath[4:] + '.yml')
-
-          if os.path.isfile(fpath):
-            try:
-              with open(fpath, 'rb') as f:
-                r = [ 'application/yaml', 200, f.read() ]
-
-              if os.path.isfile(fpath + '.lock'):
-                readonly = True
-
-              os.utime(fpath, None)
-
-            except Exception:
-              r = [ 'text/plain', 500, '500 Internal Server Error\r\n'.encode('utf-8') ]
-
-          else:
-            r = [ 'text/plain', 404, '404 Not Found\r\n'.encode('utf-8') ]
-
         else:
           r = [ 'text/plain', 503, '503 Service Unavailable\r\n'.encode('utf-8') ]
 
-      elif not re.search(r'[^A-Za-z0-9_./-]', fpath) and not re.search(r'\.{2,}', fpath) and os.path.isfile(base + '/www' + fpath):
-        if fpath.endswith('.js'):
-          ctype = 'text/javascript'
-        elif fpath.endswith('.css'):
-          ctype = 'text/css'
-        elif fpath.endswith('png'):
-          ctype = 'image/png'
+      elif fpath in assets:
+        asset = assets[fpath]
+
+        if '?v=' in self.path or '&v=' in self.path:
+          headers['Cache-Control'] = 'public, max-age=31536000, immutable'
         else:
-          ctype = 'text/html'
+          headers['Cache-Control'] = 'no-cache'
 
-        try:
-          with open(base + '/www' + fpath, 'rb') as f:
-            r = [ ctype, 200, f.read() ]
+        headers['Vary'] = 'Accept-Encoding'
 
-            if fpath == '/index.html':
-              if repository or aws_s3_url:
-                get_link = 'true'
-              else:
-                get_link = 'false'
+        if asset[3] is not None and self.accepts(self.accept_encoding(), 'gzip') > 0:
+          headers['ETag'] = asset[2][:-1] + '-gz"'
+          headers['Content-Encoding'] = 'gzip'
+          r = [ asset[0], 200, asset[3] ]
 
-              r[2] = r[2].decode('utf-8').replace('{{ jinjafx.version }}', jinjafx.__version__).replace('{{ get_link }}', get_link).encode('utf-8')
+        else:
+          headers['ETag'] = asset[2]
+          r = [ asset[0], 200, asset[1] ]
 
-        except Exception:
-          r = [ 'text/plain', 500, '500 Internal Server Error\r\n'.encode('utf-8') ]
+        if headers['ETag'] in re.split(r'\s*,\s*', self.headers.get('If-None-Match', '')):
+          r = [ asset[0], 304, b'' ]
 
       else:
         r = [ 'text/plain', 404, '404 Not Found\r\n'.encode('utf-8') ]
@@ -188,13 +342,21 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
 
     self.send_response(r[1])
     self.send_header('Content-Type', r[0])
-    self.send_header('Content-Length', str(len(r[2])))
+
+    if r[1] != 304:
+      self.send_header('Content-Length', str(len(r[2])))
+
+    for k, v in headers.items():
+      self.send_header(k, v)
 
     if readonly != None:
       if readonly:
         self.send_header('X-Read-Only', 'true')
       else:
         self.send_header('X-Read-Only', 'false')
+
+    if hasattr(self, 'healthy'):
+      self.send_header('X-Workers', self.healthy)
       
     self.end_headers()
     self.wfile.write(r[2])
@@ -204,73 +366,100 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
     uc = self.path.split('?', 1)
     params = { x[0]: x[1] for x in [x.split('=') for x in uc[1].split('&') ] } if len(uc) > 1 else { }
     fpath = uc[0]
+    headers = {}
 
     if 'Content-Length' in self.headers:
-      postdata = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+      postlen = int(self.headers['Content-Length'])
+      postdata = self.rfile.read(postlen) if postlen < post_limit else b''
+
+      if postlen < post_limit:
+        if fpath == '/jinjafx' and self.rate_limited(rl_jinjafx, headers):
+          r = [ 'text/plain', 429, '429 Too Many Requests\r\n' ]
+
+        elif fpath == '/jinjafx/batch':
+          jobs = None
 
-      if len(postdata) < (256 * 1024):
-        if fpath == '/jinjafx':
           if self.headers['Content-Type'] == 'application/json':
             try:
-              gvars = {}
-  
-              dt = json.loads(postdata)
-              template = base64.b64decode(dt['template']) if 'template' in dt and len(dt['template'].strip()) > 0 else ''
-              data = base64.b64decode(dt['data']) if 'data' in dt and len(dt['data'].strip()) > 0 else ''
-  
-              if 'vars' in dt and len(dt['vars'].strip()) > 0:
-                gyaml = base64.b64decode(dt['vars'])
+              jobs = json.loads(bytes(postdata))['jobs']
+              if not isinstance(jobs, list) or not all([ isinstance(job, dict) for job in jobs ]):
+                jobs = None
+
+            except Exception:
+              pass
 
-                if 'vault_password' in dt:
-                  vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(base64.b64decode(dt['vault_password'])))])
+          # each job is charged against "-rlj", so a batch can't contain more jobs than the bucket can ever hold
+          if jobs is not None and (len(jobs) > batch_limit or (rl_jinjafx is not None and len(jobs) > rl_jinjafx.rate)):
+            r = [ 'text/plain', 413, '413 Request Entity Too Large\r\n' ]
 
-                  if gyaml.decode('utf-8').startswith('$ANSIBLE_VAULT;'):
-                    gyaml = vault.decrypt(gyaml).decode('utf-8')
+          elif jobs is not None and self.rate_limited(rl_jinjafx, headers, max(len(jobs), 1)):
+            r = [ 'text/plain', 429, '429 Too Many Requests\r\n' ]
 
-                  def yaml_vault_tag(loader, node):
-                    return vault.decrypt(node.value).decode('utf-8')
+          elif jobs is not None:
+            st = time.time()
+            w = self.send_chunked('application/x-ndjson', headers)
+            futures = [ batch_executor.submit(jinjafx_batch_job, job.get('id', i), job, st) for i, job in enumerate(jobs) ]
+            errors = 0
 
-                  yaml.add_constructor('!vault', yaml_vault_tag, yaml.FullLoader)
+            for f in concurrent.futures.as_completed(futures):
+              jsr = f.result()
+              errors += jsr['status'] != 'ok'
+              w.write((json.dumps(jsr, ensure_ascii=False) + '\n').encode('utf-8'))
+              w.flush()
+
+            w.write((json.dumps({ 'status': 'ok', 'jobs': len(jobs), 'errors': errors, 'elapsed': round((time.time() - st) * 1000) }) + '\n').encode('utf-8'))
+            w.close()
+            return
+
+          else:
+            r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
+
+        elif fpath == '/jinjafx':
+          if self.headers['Content-Type'] == 'application/json':
+            accept = self.headers.get('Accept', '')
+            stream = None
+
+            if 'application/x-ndjson' in accept and 'application/zip' not in accept:
+              stream = JinjaFxOutputStream(self.send_chunked('application/x-ndjson', headers))
+
+            try:
+              dt = json_fields(postdata)
+              jsr, cache = jinjafx_job(b64decode(dt, 'template'), b64decode(dt, 'data'), b64decode(dt, 'vars'), b64decode(dt, 'vault_password') if 'vault_password' in dt else None, jinjafx_preview(dt), stream)
 
-                gvars.update(yaml.load(gyaml, Loader=yaml.FullLoader))
-  
-              st = round(time.time() * 1000)
-              outputs = jinjafx.JinjaFx().jinjafx(template, data, gvars, 'Output')
-              ocount = 0
-  
-              jsr = {
-                'status': 'ok',
-                'elapsed': round(time.time() * 1000) - st,
-                'outputs': {}
-              }
-  
-              for o in outputs:
-                output = '\n'.join(outputs[o]) + '\n'
-                if len(output.strip()) > 0:
-                  jsr['outputs'].update({ o: base64.b64encode(output.encode('utf-8')).decode('utf-8') })
-                  ocount += 1
-  
-              if ocount == 0:
-                raise Exception('nothing to output')
-  
             except Exception as e:
-              tb = traceback.format_exc()
-              match = re.search(r'[\s\S]*File "<(?:template|unknown)>", line ([0-9]+), in.*template', tb, re.IGNORECASE)
-              if match:
-                error = 'error[template.j2:' + match.group(1) + ']: ' + type(e).__name__ + ': ' + str(e)
-              elif 'yaml.FullLoader' in tb:
-                error = 'error[vars.yml]: ' + type(e).__name__ + ': ' + str(e)
-              else:
-                traceback.print_exc()
-                error = 'error[' + str(sys.exc_info()[2].tb_lineno) + ']: ' + type(e).__name__ + ': ' + str(e)
+              jsr, cache = { 'status': 'error', 'error': jinjafx_error(e) }, None
 
-              jsr = {
-                'status': 'error',
-                'error': error
-              }
-              self.log_request('ERR', error);
-  
-            r = [ 'application/json', 200, json.dumps(jsr) ]
+            if cache is not None:
+              headers['X-Cache'] = cache
+              self.cache = ' [cache ' + cache.lower() + ', ' + result_cache.stats() + ']'
+
+            if jsr['status'] != 'ok':
+              self.log_request('ERR', jsr['error'])
+
+            if stream is not None:
+              outputs = jsr.pop('outputs', {})
+
+              if not stream.called:
+                stream({ '0:' + o: [ output[:-1] ] for o, output in outputs.items() })
+
+              if cache is not None:
+                jsr['cache'] = cache
+
+              stream.close(jsr)
+              return
+
+            if 'application/zip' in accept and jsr['status'] == 'ok':
+              self.send_zip(jsr['outputs'], headers)
+              return
+
+            elif 'application/vnd.jinjafx+json' in accept:
+              r = [ 'application/vnd.jinjafx+json', 200, json.dumps(jsr, ensure_ascii=False) ]
+
+            else:
+              for o in jsr.get('outputs', {}):
+                jsr['outputs'][o] = base64.b64encode(jsr['outputs'][o].encode('utf-8')).decode('utf-8')
+
+              r = [ 'application/json', 200, json.dumps(jsr) ]
   
           else:
             r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
@@ -278,73 +467,39 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
         elif not api_only:
           if fpath == '/download':
             if self.headers['Content-Type'] == 'application/json':
-              lterminator = '\r\n' if 'User-Agent' in self.headers and 'windows' in self.headers['User-Agent'].lower() else '\n'
-
               try:
-                outputs = json.loads(postdata)
-
-                zfile = io.BytesIO()
-                z = zipfile.ZipFile(zfile, 'w', zipfile.ZIP_DEFLATED)
+                outputs = json.loads(bytes(postdata))
 
                 for o in outputs:
-                  ofile = re.sub(r'_+', '_', re.sub(r'[^A-Za-z0-9_. -/]', '_', os.path.normpath(o)))
-                  outputs[o] = re.sub(r'\r?\n', lterminator, base64.b64decode(outputs[o]).decode('utf-8'))
-
-                  if '.' not in ofile:
-                    if re.search(r'<html.*?>[\s\S]+<\/html>', outputs[o], re.IGNORECASE):
-                      ofile += '.html'
-                    else:
-                      ofile += '.txt'
+                  outputs[o] = base64.b64decode(outputs[o]).decode('utf-8')
 
-                  z.writestr(ofile, outputs[o])
-
-                z.close()
+              except Exception as e:
+                traceback.print_exc()
+                outputs = None
 
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/zip')
-                self.send_header('Content-Length', str(len(zfile.getvalue())))
-                self.send_header('X-Download-Filename', 'Outputs.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.zip')
-                self.end_headers()
-                self.wfile.write(zfile.getvalue())
+              if outputs is not None:
+                self.send_zip(outputs)
                 return
 
-              except Exception as e:
-                traceback.print_exc()
-                r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
+              r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
 
             else:
               r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
 
           elif fpath == '/get_link':
-            if aws_s3_url or repository:
+            if aws_s3 or repository:
               if self.headers['Content-Type'] == 'application/json':
                 try:
-                  remote_addr = str(self.client_address[0])
-                  user_agent = None
-
-                  if hasattr(self, 'headers'):
-                    if 'User-Agent' in self.headers:
-                      user_agent = self.headers['User-Agent']
-                    if 'X-Forwarded-For' in self.headers:
-                      remote_addr = self.headers['X-Forwarded-For']
+                  remote_addr = self.remote_addr()
+                  user_agent = self.headers.get('User-Agent')
 
-                  ratelimit = False
-                  if rl_rate != 0:
-                    rtable.setdefault(remote_addr, []).append(int(time.time()))
-
-                    if len(rtable[remote_addr]) > rl_rate:
-                      if (rtable[remote_addr][-1] - rtable[remote_addr][0]) <= rl_limit:
-                        ratelimit = True
-
-                      rtable[remote_addr] = rtable[remote_addr][-rl_rate:]
-
-                  if not ratelimit:
-                    dt = json.loads(postdata)
+                  if not self.rate_limited(rl_link, headers):
+                    dt = json_fields(postdata)
 
                     vdt = {}
-                    vdt['data'] = base64.b64decode(dt['data']).decode('utf-8') if 'data' in dt and len(dt['data'].strip()) > 0 else ''
-                    vdt['template'] = base64.b64decode(dt['template']).decode('utf-8') if 'template' in dt and len(dt['template'].strip()) > 0 else ''
-                    vdt['vars'] = base64.b64decode(dt['vars']).decode('utf-8') if 'vars' in dt and len(dt['vars'].strip()) > 0 else ''
+                    vdt['data'] = b64decode(dt, 'data').decode('utf-8')
+                    vdt['template'] = b64decode(dt, 'template').decode('utf-8')
+                    vdt['vars'] = b64decode(dt, 'vars').decode('utf-8')
 
                     dt_yml = '---\n'
                     dt_yml += 'dt:\n'
@@ -384,46 +539,23 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
                     else:
                       dt_link = self.encode_link(hashlib.sha256((str(uuid.uuid1()) + ':' + dt_yml).encode('utf-8')).digest()[:12])
 
-                    dt_filename = 'jfx_' + dt_link + '.yml'
-
-                    if aws_s3_url:
-                      try:
-                        rr = aws_s3_get(aws_s3_url, 'jfx_' + fpath[4:] + '.yml.lock')
-                        if rr.status_code == 200:
-                          r = [ 'text/plain', 403, '403 Forbidden\r\n' ]
+                    try:
+                      st = time.perf_counter()
+                      status = (aws_s3 or repository).put_dt(dt_link, dt_yml)
+                      metrics.observe('jinjafx_storage_duration_seconds', time.perf_counter() - st, backend='s3' if aws_s3 else 'file', op='put')
 
-                        else:
-                          rr = aws_s3_put(aws_s3_url, dt_filename, dt_yml, 'application/yaml')
+                      if status == 200:
+                        r = [ 'text/plain', 200, dt_link + '\r\n' ]
 
-                          if rr.status_code == 200:
-                            r = [ 'text/plain', 200, dt_link + '\r\n' ]
+                      elif status == 403:
+                        r = [ 'text/plain', 403, '403 Forbidden\r\n' ]
 
-                          elif rr.status_code == 403:
-                            r = [ 'text/plain', 403, '403 Forbidden\r\n' ]
-
-                          else:
-                            r = [ 'text/plain', 500, '500 Internal Server Error\r\n' ]
-
-                      except Exception as e:
-                        traceback.print_exc()
+                      else:
                         r = [ 'text/plain', 500, '500 Internal Server Error\r\n' ]
 
-                    else:
-                      try:
-                        dt_filename = os.path.normpath(repository + '/' + dt_filename)
-
-                        if os.path.isfile(dt_filename + '.lock'):
-                          r = [ 'text/plain', 403, '403 Forbidden\r\n' ]
-
-                        else:
-                          with open(dt_filename, 'w') as f:
-                            f.write(dt_yml)
-
-                            r = [ 'text/plain', 200, dt_link + '\r\n' ]
-
-                      except Exception as e:
-                        traceback.print_exc()
-                        r = [ 'text/plain', 500, '500 Internal Server Error\r\n' ]
+                    except Exception as e:
+                      traceback.print_exc()
+                      r = [ 'text/plain', 500, '500 Internal Server Error\r\n' ]
 
                   else:
                     r = [ 'text/plain', 429, '429 Too Many Requests\r\n' ]
@@ -446,171 +578,1321 @@ class JinjaFxRequest(BaseHTTPRequestHandler):
                     
       else:
         r = [ 'text/plain', 413, '413 Request Entity Too Large\r\n' ]
+        self.close_connection = True
 
     else:
       r = [ 'text/plain', 400, '400 Bad Request\r\n' ]
 
+    content = r[2].encode('utf-8')
+
+    if fpath == '/jinjafx' and r[1] == 200:
+      content = self.encode_content(content, headers)
+
     self.send_response(r[1])
     self.send_header('Content-Type', r[0])
-    self.send_header('Content-Length', str(len(r[2])))
+    self.send_header('Content-Length', str(len(content)))
+
+    for k, v in headers.items():
+      self.send_header(k, v)
+
     self.end_headers()
-    self.wfile.write(r[2].encode('utf-8'))
+    self.wfile.write(content)
 
 
-class JinjaFxThread(threading.Thread):
-  def __init__(self, s, addr):
-    threading.Thread.__init__(self)
-    self.s = s
-    self.addr = addr
-    self.daemon = True
-    self.start()
+class JinjaFxCache():
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.size = 0
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
 
 
-  def run(self):
-    httpd = JinjaFxServer(self.addr, JinjaFxRequest, False)
-    httpd.socket = self.s
-    httpd.server_bind = self.server_close = lambda self: None
-    httpd.serve_forever()
+  def get(self, key):
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][0]
 
+      self.misses += 1
+      return None
 
-def main(rflag=False):
-  global aws_s3_url
-  global aws_access_key
-  global aws_secret_key
-  global repository
-  global rl_rate
-  global rl_limit
-  global api_only
 
-  try:
-    print('JinjaFx Server v' + jinjafx.__version__ + ' - Jinja Templating Tool')
-    print('Copyright (c) 2020-2021 Chris Mason <chris@jinjafx.org>\n')
+  def put(self, key, value, size):
+    if size <= self.max_size:
+      with self.lock:
+        if key in self.entries:
+          self.size -= self.entries.pop(key)[1]
 
-    parser = jinjafx.ArgumentParser(add_help=False)
-    parser.add_argument('-s', action='store_true', required=True)
-    parser.add_argument('-l', metavar='<address>', default='127.0.0.1', type=str)
-    parser.add_argument('-p', metavar='<port>', default=8080, type=int)
-    group_ex = parser.add_mutually_exclusive_group()
-    group_ex.add_argument('-r', metavar='<repository>', type=w_directory)
-    group_ex.add_argument('-s3', metavar='<aws s3 url>', type=str)
-    parser.add_argument('-rl', metavar='<rate/limit>', type=rlimit)
-    parser.add_argument('-api', action='store_true', default=False)
-    args = parser.parse_args()
-    api_only = args.api
-    
-    if args.s3 is not None:
-      import requests
+        self.entries[key] = (value, size)
+        self.size += size
 
-      aws_s3_url = args.s3
-      aws_access_key = os.getenv('AWS_ACCESS_KEY')
-      aws_secret_key = os.getenv('AWS_SECRET_KEY')
+        while self.size > self.max_size:
+          self.size -= self.entries.popitem(last=False)[1][1]
 
-      if aws_access_key == None or aws_secret_key == None:
-        parser.error("argument -s3: environment variables 'AWS_ACCESS_KEY' and 'AWS_SECRET_KEY' are mandatory")
 
-    if args.rl is not None:
-      args.rl = args.rl.lower().split('/', 1)
-
-      if args.rl[1].endswith('s'):
-        rl_limit = int(args.rl[1][:-1])
-      elif args.rl[1].endswith('m'):
-        rl_limit = int(args.rl[1][:-1]) * 60
-      elif args.rl[1].endswith('h'):
-        rl_limit = int(args.rl[1][:-1]) * 3600
+  def resize(self, key, size):
+    with self.lock:
+      if key in self.entries:
+        value, osize = self.entries[key]
+
+        if size <= self.max_size:
+          self.entries[key] = (value, size)
+          self.size += size - osize
+        else:
+          self.entries.pop(key)
+          self.size -= osize
+
+        while self.size > self.max_size:
+          self.size -= self.entries.popitem(last=False)[1][1]
+
+
+  def stats(self):
+    total = self.hits + self.misses
+    ratio = round(100 * self.hits / total, 1) if total > 0 else 0
+    return str(self.hits) + '/' + str(total) + ' hits (' + str(ratio) + '%), ' + jinjafx.format_bytes(self.size)
+
+
+class JinjaFxMetrics():
+  buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+  def __init__(self):
+    self.local = threading.local()
+    self.threads = []
+    self.values = {}
+    self.lock = threading.Lock()
+    self.directory = None
+    self.slot = None
+
+
+  def thread(self):
+    t = getattr(self.local, 't', None)
+
+    if t is None:
+      t = self.local.t = ({}, {})
+
+      with self.lock:
+        self.threads.append(t)
+
+    return t
+
+
+  def inc(self, name, value=1, **labels):
+    counters = self.thread()[0]
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + value
+
+
+  def observe(self, name, value, **labels):
+    histograms = self.thread()[1]
+    key = (name, tuple(sorted(labels.items())))
+    h = histograms.get(key)
+
+    if h is None:
+      h = histograms[key] = [0] * (len(self.buckets) + 2)
+
+    h[bisect.bisect_left(self.buckets, value)] += 1
+    h[-1] += value
+
+
+  def set(self, name, value, **labels):
+    self.values[(name, tuple(sorted(labels.items())))] = value
+
+
+  def snapshot(self):
+    counters = dict(self.values)
+    histograms = {}
+
+    with self.lock:
+      threads = list(self.threads)
+
+    for c, h in threads:
+      for k, v in c.copy().items():
+        counters[k] = counters.get(k, 0) + v
+
+      for k, v in h.copy().items():
+        histograms[k] = [a + b for a, b in zip(histograms[k], v)] if k in histograms else list(v)
+
+    return counters, histograms
+
+
+  def dump(self, slot):
+    counters, histograms = self.snapshot()
+    fd, tpath = tempfile.mkstemp(dir=self.directory)
+
+    with os.fdopen(fd, 'w') as f:
+      json.dump([ list(counters.items()), list(histograms.items()) ], f)
+
+    os.replace(tpath, os.path.join(self.directory, str(slot) + '.json'))
+
+
+  def render(self):
+    counters, histograms = self.snapshot()
+
+    if self.directory is not None:
+      for fpath in glob.glob(os.path.join(self.directory, '*.json')):
+        if os.path.basename(fpath) != str(self.slot) + '.json':
+          try:
+            with open(fpath) as f:
+              c, h = json.load(f)
+
+          except (OSError, ValueError):
+            continue
+
+          for k, v in c:
+            k = (k[0], tuple(map(tuple, k[1])))
+            counters[k] = counters.get(k, 0) + v
+
+          for k, v in h:
+            k = (k[0], tuple(map(tuple, k[1])))
+            histograms[k] = [a + b for a, b in zip(histograms[k], v)] if k in histograms else v
+
+    def series(name, labels, extra=()):
+      labels = labels + extra
+      return name + ('{' + ','.join([ k + '="' + str(v) + '"' for k, v in labels ]) + '}' if labels else '')
+
+    lines = []
+    ctype = None
+
+    for (name, labels), v in sorted(counters.items()):
+      if name != ctype:
+        lines.append('# TYPE ' + name + (' counter' if name.endswith('_total') else ' gauge'))
+        ctype = name
+
+      lines.append(series(name, labels) + ' ' + str(v))
+
+    for (name, labels), h in sorted(histograms.items()):
+      if name != ctype:
+        lines.append('# TYPE ' + name + ' histogram')
+        ctype = name
+
+      n = 0
+      for i, le in enumerate(self.buckets + ('+Inf',)):
+        n += h[i]
+        lines.append(series(name + '_bucket', labels, (('le', le),)) + ' ' + str(n))
+
+      lines.append(series(name + '_sum', labels) + ' ' + str(round(h[-1], 6)))
+      lines.append(series(name + '_count', labels) + ' ' + str(n))
+
+    return '\n'.join(lines) + '\n'
+
+
+class JinjaFxRateLimiter():
+  def __init__(self, rate, interval, max_keys=65536):
+    self.rate = rate
+    self.interval = interval
+    self.max_keys = max_keys
+    self.buckets = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+
+  def acquire(self, key, n=1):
+    now = time.monotonic()
+
+    with self.lock:
+      bucket = self.buckets.pop(key, None)
+      tokens = self.rate if bucket is None else min(self.rate, bucket[0] + (now - bucket[1]) * self.rate / self.interval)
+
+      if tokens >= n:
+        tokens -= n
+        retry = 0
       else:
-        rl_limit = int(args.rl[1][:-1])
+        retry = math.ceil((n - tokens) * self.interval / self.rate)
 
-      rl_rate = int(args.rl[0])
+      self.buckets[key] = (tokens, now)
 
-    jinjafx.import_filters()
+      if len(self.buckets) > self.max_keys:
+        self.buckets.popitem(last=False)
 
-    log('Starting JinjaFx Server on http://' + args.l + ':' + str(args.p) + '...')
+      return retry
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((args.l, args.p))
-    s.listen(5)
 
-    threads = []
-    rflag = True
-    repository = args.r
+class JinjaFxS3Repository():
+  def __init__(self, s3_url, access_key, secret_key, cache_size=16 * 1024 * 1024):
+    m = re.match(r'(?i)^(https?)://([^/]+)(/.*)?$', s3_url)
 
-    for i in range(64):
-      threads.append(JinjaFxThread(s, (args.l, args.p)))
+    if m:
+      self.url = m.group(1).lower() + '://' + m.group(2)
+      self.host = m.group(2)
+      self.prefix = (m.group(3) or '').rstrip('/')
+      self.region = os.getenv('AWS_REGION', 'us-east-1')
 
-    while True:
-      time.sleep(0.1)
+    else:
+      self.url = 'https://' + s3_url
+      self.host = s3_url
+      self.prefix = ''
+      self.region = s3_url.split('.')[2]
 
-  except KeyboardInterrupt:
-    sys.exit(-1)
+    self.access_key = access_key
+    self.secret_key = secret_key
+    self.skeys = {}
 
-  except Exception as e:
-    exc_type, exc_obj, exc_tb = sys.exc_info()
-    print('error[' + str(exc_tb.tb_lineno) + ']: ' + str(e), file=sys.stderr)
-    sys.exit(-2)
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=64)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
 
-  finally:
-    if rflag is True:
-      log('Terminating JinjaFx Server...')
-      s.shutdown(1)
-      s.close()
+    self.executor = ThreadPoolExecutor(max_workers=16)
+    self.cache = JinjaFxCache(cache_size)
 
 
-def log(t):
-  with lock:
-    print('[' + datetime.datetime.now().strftime('%b %d %H:%M:%S.%f')[:19] + '] {' + str(os.getpid()) + '} ' + t)
+  def signing_key(self, date):
+    skey = self.skeys.get(date)
 
+    if skey is None:
+      dkey = hmac.new(('AWS4' + self.secret_key).encode('utf-8'), date.encode('utf-8'), hashlib.sha256).digest()
+      drkey = hmac.new(dkey, self.region.encode('utf-8'), hashlib.sha256).digest()
+      drskey = hmac.new(drkey, b's3', hashlib.sha256).digest()
+      skey = hmac.new(drskey, b'aws4_request', hashlib.sha256).digest()
+      self.skeys = { date: skey }
 
-def w_directory(d):
-  if not os.path.isdir(d):
-    raise argparse.ArgumentTypeError("repository directory '" + d + "' must exist")
-  elif not os.access(d, os.W_OK):
-    raise argparse.ArgumentTypeError("repository directory '" + d + "' must be writable")
-  return d
+    return skey
+
+
+  def authorization(self, method, fname, headers):
+    sheaders = ';'.join(map(lambda k: k.lower(), sorted(headers.keys())))
+    srequest = headers['x-amz-date'][:8] + '/' + self.region + '/s3/aws4_request'
+    cr = method.upper() + '\n' + self.prefix + '/' + fname + '\n\n' + '\n'.join([ k.lower() + ':' + v for k, v in sorted(headers.items()) ]) + '\n\n' + sheaders + '\n' + headers['x-amz-content-sha256']
+    s2s = 'AWS4-HMAC-SHA256\n' + headers['x-amz-date'] + '\n' + srequest + '\n' + hashlib.sha256(cr.encode('utf-8')).hexdigest()
+
+    signature = hmac.new(self.signing_key(headers['x-amz-date'][:8]), s2s.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=' + self.access_key + '/' + srequest + ', SignedHeaders=' + sheaders + ', Signature=' + signature
+    return headers
+
+
+  def request(self, method, fname, content=b'', ctype=None, extra={}):
+    headers = {
+      'Host': self.host,
+      'x-amz-content-sha256': hashlib.sha256(content).hexdigest(),
+      'x-amz-date': datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    }
+
+    if method == 'PUT':
+      headers['Content-Length'] = str(len(content))
+      headers['Content-Type'] = ctype
+
+    headers = self.authorization(method, fname, headers)
+    headers.update(extra)
+    return self.session.request(method, self.url + self.prefix + '/' + fname, headers=headers, data=content if method == 'PUT' else None, timeout=timeout)
+
+
+  def get_dt(self, dt_id):
+    fname = 'jfx_' + dt_id + '.yml'
+    flock = self.executor.submit(self.request, 'HEAD', fname + '.lock')
+    cached = self.cache.get(fname)
+
+    rr = self.request('GET', fname, extra={ 'If-None-Match': cached[0] } if cached is not None else {})
+
+    if rr.status_code == 304 and cached is not None:
+      content = cached[1]
+
+    elif rr.status_code == 200:
+      content = rr.content
+
+      if 'ETag' in rr.headers:
+        self.cache.put(fname, (rr.headers['ETag'], content), len(content))
+
+    else:
+      return rr.status_code, None, False
+
+    return 200, content, flock.result().status_code == 200
+
+
+  def put_dt(self, dt_id, content):
+    fname = 'jfx_' + dt_id + '.yml'
+    content = content.encode('utf-8')
+
+    if self.request('HEAD', fname + '.lock').status_code == 200:
+      return 403
+
+    rr = self.request('PUT', fname, content, 'application/yaml')
+
+    if rr.status_code == 200 and 'ETag' in rr.headers:
+      self.cache.put(fname, (rr.headers['ETag'], content), len(content))
+
+    return rr.status_code
+
+
+class JinjaFxFileRepository():
+  def __init__(self, directory, cache_size=16 * 1024 * 1024, ttl=1.0, interval=60):
+    self.directory = directory
+    self.cache = JinjaFxCache(cache_size)
+    self.ttl = ttl
+    self.interval = interval
+    self.atimes = set()
+    self.lock = threading.Lock()
+    self.thread = None
+
+    umask = os.umask(0)
+    os.umask(umask)
+    self.mode = 0o666 & ~umask
+
+
+  def path(self, dt_id):
+    h = hashlib.sha256(dt_id.encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, h[:2], h[2:4], 'jfx_' + dt_id + '.yml')
+
+
+  def migrate(self):
+    n = 0
+
+    with os.scandir(self.directory) as it:
+      for e in it:
+        m = re.match(r'^jfx_([A-Za-z0-9_-]{1,24})\.yml(\.lock)?$', e.name)
+
+        if m and e.is_file():
+          fpath = self.path(m.group(1)) + (m.group(2) or '')
+          os.makedirs(os.path.dirname(fpath), exist_ok=True)
+          os.replace(e.path, fpath)
+          n += 1
+
+    if n > 0:
+      log('Migrated ' + str(n) + ' file(s) into sharded repository layout')
+
+
+  def touch(self, fpath):
+    with self.lock:
+      self.atimes.add(fpath)
+
+      if self.thread is None or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self.utime, daemon=True)
+        self.thread.start()
+
+
+  def utime(self):
+    while True:
+      time.sleep(self.interval)
+
+      with self.lock:
+        atimes, self.atimes = self.atimes, set()
+
+      for fpath in atimes:
+        try:
+          os.utime(fpath, None)
+
+        except FileNotFoundError:
+          pass
+
+
+  def get_dt(self, dt_id):
+    fpath = self.path(dt_id)
+    cached = self.cache.get(dt_id)
+    now = time.monotonic()
+
+    if cached is not None and (now - cached[3]) < self.ttl:
+      self.touch(fpath)
+      return 200, cached[0], cached[2]
+
+    try:
+      st = os.stat(fpath)
+
+    except FileNotFoundError:
+      return 404, None, False
+
+    if cached is not None and cached[1] == (st.st_ino, st.st_size):
+      content = cached[0]
+
+    else:
+      with open(fpath, 'rb') as f:
+        content = f.read()
+
+    readonly = os.path.isfile(fpath + '.lock')
+    self.cache.put(dt_id, [ content, (st.st_ino, st.st_size), readonly, now ], len(content))
+    self.touch(fpath)
+    return 200, content, readonly
+
+
+  def put_dt(self, dt_id, content):
+    fpath = self.path(dt_id)
+    content = content.encode('utf-8')
+
+    if os.path.isfile(fpath + '.lock'):
+      return 403
+
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    fd, tpath = tempfile.mkstemp(dir=os.path.dirname(fpath), prefix='.jfx_')
+
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        os.fchmod(fd, self.mode)
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+      os.replace(tpath, fpath)
+
+    except Exception:
+      os.unlink(tpath)
+      raise
+
+    st = os.stat(fpath)
+    self.cache.put(dt_id, [ content, (st.st_ino, st.st_size), False, time.monotonic() ], len(content))
+    return 200
+
+
+class JinjaFxOutputStream():
+  def __init__(self, w, interval=0.1):
+    self.w = w
+    self.interval = interval
+    self.pending = {}
+    self.flushed = time.perf_counter()
+    self.called = False
+
+
+  def __call__(self, outputs):
+    self.called = True
+
+    for o, lines in outputs.items():
+      if o not in self.pending:
+        self.pending[o] = []
+      self.pending[o] += lines
+
+    if time.perf_counter() - self.flushed >= self.interval:
+      self.flush()
+
+
+  def flush(self):
+    for o, lines in self.pending.items():
+      self.w.write((json.dumps({ 'output': o.split(':')[1], 'index': int(o.split(':')[0]), 'content': '\n'.join(lines) + '\n' }, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    self.pending = {}
+    self.w.flush()
+    self.flushed = time.perf_counter()
+
+
+  def close(self, jsr):
+    self.flush()
+    self.w.write((json.dumps(jsr) + '\n').encode('utf-8'))
+    self.w.close()
+
+
+class JinjaFxChunkedWriter():
+  def __init__(self, wfile, chunked=True, compressor=None, size=64 * 1024):
+    self.wfile = wfile
+    self.chunked = chunked
+    self.compressor = compressor
+    self.size = size
+    self.buffer = []
+    self.buffered = 0
+
+
+  def write(self, b):
+    n = len(b)
+
+    if self.compressor is not None:
+      b = self.compressor.compress(b)
+
+    self.buffer.append(b)
+    self.buffered += len(b)
+
+    if self.buffered >= self.size:
+      self.send()
+
+    return n
+
+
+  def flush(self):
+    if self.compressor is not None:
+      self.buffer.append(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    self.send()
+
+
+  def send(self, last=False):
+    b = b''.join(self.buffer)
+    self.buffer = []
+    self.buffered = 0
+
+    # the last chunk and the terminator go out in a single write so the terminator isn't left waiting for an ack
+    if self.chunked:
+      b = (('%x\r\n' % len(b)).encode('utf-8') + b + b'\r\n' if len(b) > 0 else b'') + (b'0\r\n\r\n' if last else b'')
+
+    if len(b) > 0:
+      self.wfile.write(b)
+      self.wfile.flush()
+
+
+  def close(self):
+    if self.compressor is not None:
+      self.buffer.append(self.compressor.flush())
+
+    self.send(True)
+
+
+class JinjaFxRenderError(Exception):
+  def __init__(self, etype, message, tb=None):
+    Exception.__init__(self, message)
+    self.etype = etype
+    self.tb = tb
+
+
+class JinjaFxRenderPool():
+  def __init__(self, processes, rtimeout=None, rmemory=None, maxtasks=100):
+    self.ctx = multiprocessing.get_context('forkserver')
+    self.rtimeout = rtimeout
+    self.rmemory = rmemory
+    self.maxtasks = maxtasks
+    self.idle = queue.Queue()
+
+    for i in range(processes):
+      self.idle.put(self.spawn())
+
+
+  def spawn(self):
+    conn, child_conn = self.ctx.Pipe()
+    p = self.ctx.Process(target=jinjafx_render_process, args=(child_conn, self.rmemory, max_memory, dataset_cache and dataset_cache.max_size, plan_cache.max_size), daemon=True)
+    p.start()
+    child_conn.close()
+    return [p, conn, 0]
+
+
+  def recycle(self, w):
+    w[0].kill()
+    w[0].join()
+    w[1].close()
+    return self.spawn()
+
+
+  def render(self, *args):
+    w = self.idle.get()
+
+    try:
+      # a render process which has died while idle (e.g. the oom killer) is replaced before it is used
+      if not w[0].is_alive():
+        w = self.recycle(w)
+
+      try:
+        w[1].send(args)
+        ready = w[1].poll(self.rtimeout)
+        r = w[1].recv() if ready else None
+
+      except (OSError, EOFError):
+        w = self.recycle(w)
+        raise JinjaFxRenderError('RuntimeError', 'render process terminated unexpectedly')
+
+      if not ready:
+        metrics.inc('jinjafx_render_timeouts_total')
+        w = self.recycle(w)
+        raise JinjaFxRenderError('TimeoutError', 'render exceeded time limit of ' + str(self.rtimeout) + 's')
+
+      w[2] += 1
+
+      if r[0] != 'ok':
+        if r[1] == 'MemoryError':
+          metrics.inc('jinjafx_render_memory_errors_total')
+          w = self.recycle(w)
+          raise JinjaFxRenderError(r[1], 'render exceeded memory limit of ' + jinjafx.format_bytes(self.rmemory) if self.rmemory else 'render ran out of memory')
+
+        raise JinjaFxRenderError(r[1], r[2], r[3])
+
+      if w[2] >= self.maxtasks:
+        w = self.recycle(w)
+
+      return r[1], r[2]
+
+    finally:
+      self.idle.put(w)
+
+
+def jinjafx_render_process(conn, rmemory, mmemory, dcache, pcache):
+  global max_memory
+  global dataset_cache
+  global plan_cache
+
+  max_memory = mmemory
+  dataset_cache = JinjaFxCache(dcache) if dcache else None
+  plan_cache = JinjaFxCache(pcache)
+
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+    jinjafx.import_filters()
+
+  if rmemory:
+    try:
+      with open('/proc/self/statm') as f:
+        vsize = int(f.read().split()[0]) * resource.getpagesize()
+
+    except Exception:
+      vsize = 0
+
+    resource.setrlimit(resource.RLIMIT_AS, (vsize + rmemory, vsize + rmemory))
+
+  try:
+    while True:
+      args = conn.recv()
+
+      try:
+        conn.send(('ok',) + jinjafx_render_plan(*args))
+
+      except MemoryError:
+        conn.send(('error', 'MemoryError'))
+
+      except Exception as e:
+        conn.send(('error', type(e).__name__, str(e), traceback.format_exc()))
+
+  except (EOFError, KeyboardInterrupt):
+    pass
+
+
+def json_fields(b):
+  m = re.match(br'\s*\{\s*', b)
+
+  if m:
+    fields = {}
+    pos = m.end()
+
+    while True:
+      m = json_field_re.match(b, pos)
+      if not m:
+        break
+
+      g = 2 if m.group(2) is not None else 3
+      fields[m.group(1).decode('utf-8')] = b[m.start(g):m.end(g)]
+      pos = m.end()
+
+      if m.group(4) == b'}':
+        if re.match(br'\s*$', b[pos:]):
+          return fields
+        break
+
+  return json.loads(bytes(b))
+
+
+def b64decode(dt, key):
+  if key in dt:
+    return binascii.a2b_base64(dt[key])
+  return b''
+
+
+def jinjafx_phase(name, pt):
+  now = time.perf_counter()
+  metrics.observe('jinjafx_render_phase_seconds', now - pt, phase=name)
+  return now
+
+
+def jinjafx_preview(dt):
+  if 'preview' in dt or 'preview_bytes' in dt:
+    preview = tuple([ int(dt[k] if isinstance(dt[k], (int, str)) else bytes(dt[k])) if k in dt else None for k in ('preview', 'preview_bytes') ])
+
+    if any([ p is not None and p < 1 for p in preview ]):
+      raise Exception('"preview" and "preview_bytes" must be at least 1')
+
+    return preview
+
+  return None
+
+
+def jinjafx_job(template, data, gyaml, vault_password=None, preview=None, stream=None):
+  pt = time.perf_counter()
+  cache = None
+
+  try:
+    gvars = {}
+
+    if len(gyaml) > 0:
+      if vault_password is not None:
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(vault_password))])
+
+        if gyaml.decode('utf-8').startswith('$ANSIBLE_VAULT;'):
+          gyaml = vault.decrypt(gyaml)
+
+        class JinjaFxVaultLoader(yaml_loader):
+          pass
+
+        JinjaFxVaultLoader.add_constructor('!vault', lambda loader, node: vault.decrypt(node.value).decode('utf-8'))
+        gvars.update(jinjafx_vars(gyaml, JinjaFxVaultLoader))
+
+      else:
+        gvars.update(jinjafx_vars(gyaml))
+
+    pt = jinjafx_phase('parse', pt)
+    st = round(time.time() * 1000)
+    ckey = None
+    cached = None
+
+    if result_cache is not None and vault_password is None and b'nslookup' not in template:
+      ckey = hashlib.sha256(b''.join([ hashlib.sha256(f).digest() for f in (str(preview).encode('utf-8'), template, data, gyaml) ])).digest()
+      cached = result_cache.get(ckey)
+      cache = 'MISS' if cached is None else 'HIT'
+
+    if cached is None:
+      outputs, stats = jinjafx_render(template, data, gvars, *(preview or ()), stream=stream)
+      pt = jinjafx_phase('render', pt)
+      metrics.inc('jinjafx_rows_rendered_total', stats['rows'])
+      ocount = 0
+
+      jsr = {
+        'status': 'ok',
+        'elapsed': round(time.time() * 1000) - st,
+        'outputs': {}
+      }
+
+      if preview is not None:
+        jsr['preview'] = stats
+
+      for o in outputs:
+        output = '\n'.join(outputs[o]) + '\n'
+        if len(output.strip()) > 0:
+          jsr['outputs'].update({ o: output })
+          ocount += 1
+
+      if ocount == 0:
+        raise Exception('nothing to output')
+
+      jinjafx_phase('output', pt)
+
+      if ckey is not None:
+        result_cache.put(ckey, (dict(jsr['outputs']), jsr.get('preview')), sum([len(k) + len(v) for k, v in jsr['outputs'].items()]))
+
+    else:
+      jsr = {
+        'status': 'ok',
+        'elapsed': round(time.time() * 1000) - st,
+        'outputs': dict(cached[0])
+      }
+
+      if cached[1] is not None:
+        jsr['preview'] = cached[1]
+
+  except Exception as e:
+    jsr = {
+      'status': 'error',
+      'error': jinjafx_error(e)
+    }
+
+  return jsr, cache
+
+
+def jinjafx_vars(gyaml, loader=None):
+  if loader is not None:
+    gvars = yaml.load(gyaml, Loader=loader) or {}
+
+  else:
+    vkey = hashlib.sha256(gyaml).digest()
+    gvars = vars_cache.get(vkey)
+
+    if gvars is None:
+      gvars = yaml.load(gyaml, Loader=yaml_loader) or {}
+      if isinstance(gvars, dict):
+        vars_cache.put(vkey, gvars, len(gyaml))
+
+    if render_pool is None:
+      gvars = copy.deepcopy(gvars)
+
+  if not isinstance(gvars, dict):
+    raise yaml.YAMLError('expected a mapping at the top level of vars.yml')
+
+  return gvars
+
+
+def jinjafx_error(e):
+  tb = getattr(e, 'tb', None) or traceback.format_exc()
+  etype = getattr(e, 'etype', type(e).__name__)
+  match = re.search(r'[\s\S]*File "<(?:template|unknown)>", line ([0-9]+), in.*template', tb, re.IGNORECASE)
+  if match:
+    return 'error[template.j2:' + match.group(1) + ']: ' + etype + ': ' + str(e)
+  elif isinstance(e, yaml.YAMLError):
+    return 'error[vars.yml]: ' + etype + ': ' + str(e)
+  elif isinstance(e, JinjaFxRenderError):
+    return 'error[render]: ' + etype + ': ' + str(e)
+
+  traceback.print_exc()
+  return 'error[' + str(sys.exc_info()[2].tb_lineno) + ']: ' + etype + ': ' + str(e)
+
+
+def jinjafx_batch_job(jid, job, st):
+  try:
+    if 'dt' in job:
+      if not (aws_s3 or repository):
+        raise Exception('no repository configured')
+
+      if not re.search(r'^[A-Za-z0-9_-]{1,24}$', str(job['dt'])):
+        raise Exception('invalid link format')
+
+      status, content, readonly = (aws_s3 or repository).get_dt(job['dt'])
+      if status != 200:
+        raise Exception('unable to retrieve DataTemplate (' + str(status) + ')')
+
+      dt = yaml.safe_load(content)['dt']
+      args = [ (dt.get(k) or '').encode('utf-8') for k in ('template', 'data', 'vars') ]
+
+    else:
+      args = [ b64decode(job, k) for k in ('template', 'data', 'vars') ]
+
+    args.append(b64decode(job, 'vault_password') if 'vault_password' in job else None)
+    args.append(jinjafx_preview(job))
+
+  except Exception as e:
+    jsr = { 'status': 'error', 'error': 'error[job]: ' + type(e).__name__ + ': ' + str(e) }
+
+  else:
+    jsr = jinjafx_job(*args)[0]
+
+  jsr = dict(job=jid, **jsr)
+  jsr['completed'] = round((time.time() - st) * 1000)
+  return jsr
+
+
+def jinjafx_render(template, data, gvars, limit_rows=None, limit_bytes=None, stream=None):
+  if render_pool is not None:
+    return render_pool.render(template, data, gvars, limit_rows, limit_bytes)
+
+  return jinjafx_render_plan(template, data, gvars, limit_rows, limit_bytes, stream)
+
+
+def jinjafx_render_plan(template, data, gvars, limit_rows=None, limit_bytes=None, stream=None):
+  dkey, dataset = jinjafx_dataset(data, gvars, limit_rows)
+  memory = dataset.memory if dkey is not None else None
+
+  try:
+    return jinjafx_plan(template, gvars).render(dataset, gvars, limit_rows, limit_bytes, None, max_memory, None, stream)
+
+  finally:
+    # indexes built by lookup() or group() stay with the cached dataset, so its entry grows with them
+    if dkey is not None and dataset.memory != memory:
+      dataset_cache.resize(dkey, dataset.memory)
+
+
+def jinjafx_plan(template, gvars):
+  extensions = gvars.get('jinja2_extensions', [])
+  pkey = hashlib.sha256(json.dumps(extensions, default=str).encode('utf-8') + b'\0' + template).digest()
+  plan = plan_cache.get(pkey)
+
+  if plan is None:
+    plan = jinjafx.JinjaFxPlan(template, 'Output', extensions)
+    plan_cache.put(pkey, plan, len(template) * 8)
+
+  return plan
+
+
+def jinjafx_dataset(data, gvars, limit=None):
+  if dataset_cache is None or len(data) == 0:
+    return None, data
+
+  dopts = json.dumps([ gvars.get(k) for k in ('jinjafx_adjust_headers', 'jinjafx_filter', 'jinjafx_sort') ] + [ limit ], sort_keys=True, default=str)
+  dkey = hashlib.sha256(dopts.encode('utf-8') + b'\0' + data).digest()
+  dataset = dataset_cache.get(dkey)
+
+  if dataset is None:
+    dataset = jinjafx.JinjaFx().prepare(data, gvars, limit, max_memory)
+    dataset_cache.put(dkey, dataset, dataset.memory)
+
+  return dkey, dataset
+
+
+class JinjaFxReader():
+  def __init__(self, head, body):
+    self.head = io.BytesIO(head)
+    self.body = memoryview(body)
+    self.pos = 0
+
+
+  def readline(self, size=-1):
+    return self.head.readline(size)
+
+
+  def read(self, size=-1):
+    end = len(self.body) if size < 0 else min(len(self.body), self.pos + size)
+    b = self.body[self.pos:end]
+    self.pos = end
+    return b
+
+
+class JinjaFxWriter():
+  def __init__(self, writer, loop):
+    self.writer = writer
+    self.loop = loop
+    self.buffer = []
+    self.written = 0
+
+
+  def write(self, b):
+    self.buffer.append(b)
+    self.written += len(b)
+    return len(b)
+
+
+  def flush(self):
+    if self.buffer:
+      b = b''.join(self.buffer)
+      self.buffer = []
+      asyncio.run_coroutine_threadsafe(self.send(b), self.loop).result(timeout)
+
+
+  async def send(self, b):
+    self.writer.write(b)
+    await self.writer.drain()
+
+
+def jinjafx_request(rfile, wfile, client_address):
+  metrics.inc('jinjafx_requests_queued', -1)
+  metrics.inc('jinjafx_requests_active')
+  st = time.perf_counter()
+  handler = JinjaFxRequest(rfile, wfile, client_address)
+
+  try:
+    handler.handle_one_request()
+    wfile.flush()
+
+  except Exception:
+    handler.close_connection = True
+
+  finally:
+    metrics.inc('jinjafx_requests_active', -1)
+
+  if hasattr(handler, 'status'):
+    path = metrics_path(getattr(handler, 'path', ''))
+    metrics.inc('jinjafx_requests_total', path=path, status=str(handler.status))
+    metrics.inc('jinjafx_response_bytes_total', wfile.written, path=path, status=str(handler.status))
+    metrics.observe('jinjafx_request_duration_seconds', time.perf_counter() - st, path=path, status=str(handler.status))
+
+  return handler.close_connection
+
+
+def metrics_path(path):
+  path = path.split('?', 1)[0]
+
+  if path.startswith('/dt/'):
+    return '/dt'
+
+  elif path in ('/jinjafx', '/jinjafx/batch', '/download', '/get_link', '/ping', '/metrics'):
+    return path
+
+  elif path == '/' or path in assets:
+    return 'static'
+
+  return 'other'
+
+
+def jinjafx_metrics():
+  for name, cache in (('result', result_cache), ('vars', vars_cache), ('dataset', dataset_cache), ('plan', plan_cache), ('s3', aws_s3 and aws_s3.cache), ('file', repository and repository.cache)):
+    if cache:
+      metrics.set('jinjafx_cache_hits_total', cache.hits, cache=name)
+      metrics.set('jinjafx_cache_misses_total', cache.misses, cache=name)
+      metrics.set('jinjafx_cache_bytes', cache.size, cache=name)
+
+  if render_pool is not None:
+    metrics.set('jinjafx_render_processes_idle', render_pool.idle.qsize())
+
+  return metrics.render()
+
+
+async def jinjafx_connection(reader, writer, executor):
+  loop = asyncio.get_running_loop()
+  client_address = writer.get_extra_info('peername') or ('', 0)
+
+  # the listening socket is created with proto 0, so asyncio doesn't disable nagle on accepted connections
+  sock = writer.get_extra_info('socket')
+  if sock is not None:
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  try:
+    while True:
+      try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+
+      except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        break
+
+      body = b''
+      m = re.search(br'\r\nContent-Length:[ \t]*([0-9]+)', head, re.IGNORECASE)
+
+      if m and int(m.group(1)) < post_limit:
+        if re.search(br'\r\nExpect:[ \t]*100-continue', head, re.IGNORECASE):
+          writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        body = bytearray(int(m.group(1)))
+        n = 0
+
+        try:
+          while n < len(body):
+            chunk = await asyncio.wait_for(reader.read(min(len(body) - n, 64 * 1024)), timeout)
+            if not chunk:
+              raise ConnectionError()
+
+            body[n:n + len(chunk)] = chunk
+            n += len(chunk)
+
+        except (asyncio.TimeoutError, ConnectionError):
+          break
+
+      metrics.inc('jinjafx_requests_queued')
+
+      if await loop.run_in_executor(executor, jinjafx_request, JinjaFxReader(head, body), JinjaFxWriter(writer, loop), client_address):
+        break
+
+  finally:
+    writer.close()
+
+
+async def jinjafx_heartbeat(slot):
+  n = 0
+
+  while True:
+    workers[slot] = time.time()
+
+    if n % 5 == 0:
+      jinjafx_metrics()
+      metrics.dump(slot)
+
+    n += 1
+    await asyncio.sleep(1)
+
+
+async def jinjafx_serve(s, backlog, threads, slot=None, rpool=None):
+  global render_pool
+  global batch_executor
+
+  if rpool is not None:
+    render_pool = JinjaFxRenderPool(*rpool)
+
+  batch_executor = ThreadPoolExecutor(max_workers=rpool[0] if rpool is not None else os.cpu_count())
+
+  metrics.slot = slot
+
+  executor = ThreadPoolExecutor(max_workers=threads)
+  server = await asyncio.start_server(lambda r, w: jinjafx_connection(r, w, executor), sock=s, backlog=backlog)
+
+  if slot is not None:
+    asyncio.get_running_loop().create_task(jinjafx_heartbeat(slot))
+
+  async with server:
+    await server.serve_forever()
+
+
+def jinjafx_fork(s, backlog, threads, slot, rpool):
+  workers[slot] = time.time()
+  pid = os.fork()
+
+  if pid == 0:
+    try:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      asyncio.run(jinjafx_serve(s, backlog, threads, slot, rpool))
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+      sys.stdout.flush()
+      os._exit(0)
+
+  return pid
+
+
+def main(rflag=False):
+  global aws_s3
+  global repository
+  global rl_link
+  global rl_jinjafx
+  global api_only
+  global timeout
+  global workers
+  global compress_level
+  global compress_threshold
+  global post_limit
+  global batch_limit
+  global max_memory
+  global result_cache
+  global metrics
+  global vars_cache
+  global dataset_cache
+  global plan_cache
+
+  pids = {}
+  metrics = JinjaFxMetrics()
+  vars_cache = JinjaFxCache(16 * 1024 * 1024)
+  plan_cache = JinjaFxCache(16 * 1024 * 1024)
+
+  try:
+    print('JinjaFx Server v' + jinjafx.__version__ + ' - Jinja Templating Tool')
+    print('Copyright (c) 2020-2021 Chris Mason <chris@jinjafx.org>\n')
+
+    parser = jinjafx.ArgumentParser(add_help=False)
+    parser.add_argument('-s', action='store_true', required=True)
+    parser.add_argument('-l', metavar='<address>', default='127.0.0.1', type=str)
+    parser.add_argument('-p', metavar='<port>', default=8080, type=int)
+    group_ex = parser.add_mutually_exclusive_group()
+    group_ex.add_argument('-r', metavar='<repository>', type=w_directory)
+    group_ex.add_argument('-s3', metavar='<aws s3 url>', type=str)
+    parser.add_argument('-rl', metavar='<rate/limit>', type=rlimit)
+    parser.add_argument('-rlj', metavar='<rate/limit>', type=rlimit)
+    parser.add_argument('-api', action='store_true', default=False)
+    parser.add_argument('-t', metavar='<threads>', default=64, type=int)
+    parser.add_argument('-b', metavar='<backlog>', default=128, type=int)
+    parser.add_argument('-to', metavar='<timeout>', default=30, type=int)
+    parser.add_argument('-w', metavar='<workers>', default=0, type=int)
+    parser.add_argument('-rp', metavar='<processes>', type=int)
+    parser.add_argument('-rt', metavar='<timeout>', type=int)
+    parser.add_argument('-rm', metavar='<memory>', type=bsize)
+    parser.add_argument('-zl', metavar='<level>', default=6, type=int, choices=range(1, 23))
+    parser.add_argument('-zt', metavar='<threshold>', default='1K', type=bsize)
+    parser.add_argument('-pl', metavar='<post limit>', default='256K', type=bsize)
+    parser.add_argument('-bl', metavar='<batch limit>', default=64, type=int)
+    parser.add_argument('-rc', metavar='<cache size>', type=bsize)
+    parser.add_argument('-dc', metavar='<cache size>', default='16M', type=bsize)
+    parser.add_argument('-mm', metavar='<memory>', type=bsize)
+    args = parser.parse_args()
+    api_only = args.api
+    timeout = args.to
+    compress_level = args.zl
+    compress_threshold = args.zt
+    post_limit = args.pl
+    batch_limit = args.bl
+    max_memory = args.mm
+
+    if args.rc is not None:
+      result_cache = JinjaFxCache(args.rc)
+
+    if args.dc > 0:
+      dataset_cache = JinjaFxCache(args.dc)
+    
+    if args.s3 is not None:
+      import requests
+
+      aws_access_key = os.getenv('AWS_ACCESS_KEY')
+      aws_secret_key = os.getenv('AWS_SECRET_KEY')
+
+      if aws_access_key == None or aws_secret_key == None:
+        parser.error("argument -s3: environment variables 'AWS_ACCESS_KEY' and 'AWS_SECRET_KEY' are mandatory")
+
+      aws_s3 = JinjaFxS3Repository(args.s3, aws_access_key, aws_secret_key)
+
+    if args.rl is not None:
+      rl_link = JinjaFxRateLimiter(*args.rl)
+
+    if args.rlj is not None:
+      rl_jinjafx = JinjaFxRateLimiter(*args.rlj)
+
+    rpool = None
+    if args.rp is not None or args.rt is not None or args.rm is not None:
+      rpool = (args.rp or os.cpu_count(), args.rt, args.rm)
+
+    jinjafx.import_filters()
+
+    log('Starting JinjaFx Server on http://' + args.l + ':' + str(args.p) + '...')
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((args.l, args.p))
+    s.listen(args.b)
+
+    rflag = True
+    if args.r:
+      repository = JinjaFxFileRepository(args.r)
+      repository.migrate()
+
+    if not api_only:
+      load_assets()
+
+    if args.w > 0:
+      workers = RawArray('d', args.w)
+      metrics.directory = tempfile.mkdtemp(prefix='jinjafx_metrics.')
+      signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+      for slot in range(args.w):
+        pids[jinjafx_fork(s, args.b, args.t, slot, rpool)] = slot
+
+      log('Started ' + str(args.w) + ' JinjaFx Server workers')
+
+      while True:
+        time.sleep(1)
+
+        while pids:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+          if pid == 0:
+            break
+
+          if pid in pids:
+            slot = pids.pop(pid)
+            log('JinjaFx Server worker {' + str(pid) + '} exited with status ' + str(status) + ' - restarting...')
+            pids[jinjafx_fork(s, args.b, args.t, slot, rpool)] = slot
+
+        for pid, slot in pids.items():
+          if (time.time() - workers[slot]) > (timeout * 2):
+            log('JinjaFx Server worker {' + str(pid) + '} is unresponsive - terminating...')
+            os.kill(pid, signal.SIGKILL)
+
+    else:
+      asyncio.run(jinjafx_serve(s, args.b, args.t, None, rpool))
+
+  except KeyboardInterrupt:
+    sys.exit(-1)
+
+  except Exception as e:
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    print('error[' + str(exc_tb.tb_lineno) + ']: ' + str(e), file=sys.stderr)
+    sys.exit(-2)
+
+  finally:
+    if rflag is True:
+      log('Terminating JinjaFx Server...')
+
+      for pid in pids:
+        try:
+          os.kill(pid, signal.SIGTERM)
+          os.waitpid(pid, 0)
+
+        except OSError:
+          pass
+
+      s.shutdown(1)
+      s.close()
+
+      if metrics.directory is not None:
+        shutil.rmtree(metrics.directory, ignore_errors=True)
+
+
+def load_assets():
+  base = os.path.abspath(os.path.dirname(sys.argv[0])) + '/www'
+  get_link = 'true' if repository or aws_s3 else 'false'
+  ctypes = { '.js': 'text/javascript', '.css': 'text/css', '.png': 'image/png', '.html': 'text/html' }
+
+  # html is loaded last so the "?v=" of every asset it references can be its content hash
+  for fname in sorted(os.listdir(base), key=lambda x: (x.endswith('.html'), x)):
+    ext = os.path.splitext(fname)[1]
+
+    if ext in ctypes and not re.search(r'[^A-Za-z0-9_.-]', fname):
+      with open(base + '/' + fname, 'rb') as f:
+        content = f.read()
+
+      if ext == '.html':
+        content = content.decode('utf-8')
+        content = re.sub(r'([A-Za-z0-9_.-]+)\?v=\{\{ jinjafx\.version \}\}', lambda m: m.group(1) + '?v=' + (assets['/' + m.group(1)][2][1:-1] if '/' + m.group(1) in assets else jinjafx.__version__), content)
+        content = content.replace('{{ jinjafx.version }}', jinjafx.__version__).replace('{{ get_link }}', get_link).encode('utf-8')
+
+      gzcontent = gzip.compress(content, 9, mtime=0) if ext != '.png' else None
+      if gzcontent is not None and len(gzcontent) >= len(content):
+        gzcontent = None
+
+      assets['/' + fname] = [ ctypes[ext], content, '"' + hashlib.sha256(content).hexdigest()[:32] + '"', gzcontent ]
+
+
+def log(t):
+  with lock:
+    print('[' + datetime.datetime.now().strftime('%b %d %H:%M:%S.%f')[:19] + '] {' + str(os.getpid()) + '} ' + t)
+
+
+def w_directory(d):
+  if not os.path.isdir(d):
+    raise argparse.ArgumentTypeError("repository directory '" + d + "' must exist")
+  elif not os.access(d, os.W_OK):
+    raise argparse.ArgumentTypeError("repository directory '" + d + "' must be writable")
+  return d
+
+
+def bsize(b):
+  m = re.match(r'(?i)^(\d+)([KMG]?)$', b)
+  if not m:
+    raise argparse.ArgumentTypeError("value must be a size in bytes, e.g. 262144, 256K or 64M")
+  return int(m.group(1)) * { '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }[m.group(2).upper()]
 
 
 def rlimit(rl):
-  if not re.match(r'(?i)^\d+/\d+[smh]$', rl):
+  m = re.match(r'(?i)^([1-9]\d*)/([1-9]\d*)([smh])$', rl)
+  if not m:
     raise argparse.ArgumentTypeError("value must be rate/limit, e.g. 5/30s or 30/1h")
-  return rl 
-
-
-def aws_s3_authorization(method, fname, region, headers):
-  sheaders = ';'.join(map(lambda k: k.lower(), sorted(headers.keys())))
-  srequest = headers['x-amz-date'][:8] + '/' + region + '/s3/aws4_request'
-  cr = method.upper() + '\n/' + fname + '\n\n' + '\n'.join([ k.lower() + ':' + v for k, v in sorted(headers.items()) ]) + '\n\n' + sheaders + '\n' + headers['x-amz-content-sha256']
-  s2s = 'AWS4-HMAC-SHA256\n' + headers['x-amz-date'] + '\n' + srequest + '\n' + hashlib.sha256(cr.encode('utf-8')).hexdigest()
-
-  dkey = hmac.new(('AWS4' + aws_secret_key).encode('utf-8'), headers['x-amz-date'][:8].encode('utf-8'), hashlib.sha256).digest()
-  drkey = hmac.new(dkey, region.encode('utf-8'), hashlib.sha256).digest()
-  drskey = hmac.new(drkey, b's3', hashlib.sha256).digest()
-  skey = hmac.new(drskey, b'aws4_request', hashlib.sha256).digest()
-
-  signature = hmac.new(skey, s2s.encode('utf-8'), hashlib.sha256).hexdigest()
-  headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=' + aws_access_key + '/' + srequest + ', SignedHeaders=' + sheaders + ', Signature=' + signature
-  return headers
-
-
-def aws_s3_put(s3_url, fname, content, ctype):
-  headers = {
-    'Content-Length': str(len(content)),
-    'Content-Type': ctype,
-    'Host': s3_url,
-    'x-amz-content-sha256': hashlib.sha256(content.encode('utf-8')).hexdigest(),
-    'x-amz-date': datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-  }
-  headers = aws_s3_authorization('PUT', fname, s3_url.split('.')[2], headers)
-  return requests.put('https://' + s3_url + '/' + fname, headers=headers, data=content)
-
-
-def aws_s3_get(s3_url, fname):
-  headers = {
-    'Host': s3_url,
-    'x-amz-content-sha256': hashlib.sha256(b'').hexdigest(),
-    'x-amz-date': datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-  }
-  headers = aws_s3_authorization('GET', fname, s3_url.split('.')[2], headers)
-  return requests.get('https://' + s3_url + '/' + fname, headers=headers)
+  return int(m.group(1)), int(m.group(2)) * { 's': 1, 'm': 60, 'h': 3600 }[m.group(3).lower()]
 
 
 if __name__ == '__main__':
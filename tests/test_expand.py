@@ -0,0 +1,36 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jinjafx
+
+
+class TestExpand(unittest.TestCase):
+  patterns = [
+    'Ethernet1/1',
+    'Ethernet[1-2]/{1-3:1}',
+    '(b[1-2]|a)',
+    '(a|b)(c[1-2]|d)',
+    '(t|u(v|w))[0-1]',
+    '({1-3:1}|z)[a-b]',
+    'Et[0-1]/(1|2)/{1-3:1}',
+    'r{5-1:2:3}(x|y[A-b])',
+    '\\(a\\|b\\)[1-2]',
+    '(r|s[0-1])({1-2:1}|z)a'
+  ]
+
+  def test_lazy_matches_list(self):
+    jfx = jinjafx.JinjaFx()
+    for s in self.patterns:
+      self.assertEqual(list(jfx.jfx_expand(s, lazy=True)), jfx.jfx_expand(s), s)
+
+  def test_uneven_alternation(self):
+    self.assertEqual(jinjafx.JinjaFx().jfx_expand('(b[1-2]|a)'), ['a', 'b1', 'b2'])
+
+  def test_cached_result_is_a_copy(self):
+    jfx = jinjafx.JinjaFx()
+    jfx.jfx_expand('x[1-2]').append('y')
+    self.assertEqual(jfx.jfx_expand('x[1-2]'), ['x1', 'x2'])
+
+
+if __name__ == '__main__':
+  unittest.main()